@@ -1,3 +1,5 @@
+import json
+import os
 from datetime import date
 import time
 import argparse
@@ -13,25 +15,85 @@ import torch.multiprocessing as mp
 
 from utils.set_seed import set_seed
 from loggers.ImagePredictionLogger import ImagePredictionLogger
+from loggers.SampleLossLogger import SampleLossLogger
+from loggers.ImageCacheLogger import ImageCacheLogger
 from dataset.LateralSkullRadiographDataModule import LateralSkullRadiographDataModule
+from dataset.CompositeDataModule import CompositeDataModule
+from dataset.ShardEpochCallback import ShardEpochCallback
 from models.ModelTypes import ModelTypes
+from models.LandmarkDecoders import LandmarkDecoders
 from argparse import Namespace
 
-mp.set_start_method("spawn")
-
 
 def get_args() -> dict:
     parser = argparse.ArgumentParser()
     parser.add_argument("--root_dir", type=str, default="dataset/novel")
     parser.add_argument("--csv_file", type=str, default="all_images_37_points.csv")
+    parser.add_argument("--extra_datasets", nargs="+", type=str, default=[])
+    parser.add_argument("--dataset_weights", nargs="+", type=float, default=None)
+    parser.add_argument("--point_id_maps", type=str, default=None)
+    parser.add_argument("--samples_per_epoch", type=int, default=None)
     parser.add_argument("--model_name", type=str, choices=ModelTypes.get_model_types())
     parser.add_argument("--splits", type=tuple, default=(0.8, 0.1, 0.1))
+    parser.add_argument(
+        "--split_file",
+        type=str,
+        default=None,
+        help="File the splits are saved to and reused from, with the fold "
+        "added for --folds; splits are not saved without it",
+    )
     parser.add_argument("--batch_size", type=int, default=32)
     parser.add_argument("--early_stopping_patience", type=int, default=100)
     parser.add_argument("--checkpoint", nargs="+", type=str, default=None)
     parser.add_argument("--test_only", action=argparse.BooleanOptionalAction)
     parser.add_argument("--flip_augmentations", action=argparse.BooleanOptionalAction)
+    parser.add_argument("--color_augmentations", action=argparse.BooleanOptionalAction)
+    parser.add_argument("--decode_workers", type=int, default=None)
+    parser.add_argument("--draft_decoding", action=argparse.BooleanOptionalAction)
+    parser.add_argument("--lazy_loading", action=argparse.BooleanOptionalAction)
+    parser.add_argument(
+        "--image_cache_mb",
+        type=int,
+        default=2048,
+        help="Memory of the LRU image cache of --lazy_loading, split "
+        "between all DataLoader workers",
+    )
+    parser.add_argument("--pyramid_levels", nargs="+", type=int, default=[1, 2, 3])
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--cache_max_gb", type=float, default=None)
+    parser.add_argument("--shared_memory", action=argparse.BooleanOptionalAction)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--prefetch_factor", type=int, default=2)
+    parser.add_argument(
+        "--persistent_workers",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+    )
+    parser.add_argument("--train_shards", type=str, default=None)
+    parser.add_argument("--shuffle_buffer", type=int, default=256)
+    parser.add_argument("--device_resident", action=argparse.BooleanOptionalAction)
+    parser.add_argument("--hard_example_sampling", action=argparse.BooleanOptionalAction)
+    parser.add_argument("--uniform_fraction", type=float, default=0.5)
+    parser.add_argument(
+        "--crop_level",
+        type=int,
+        default=None,
+        help="Train on crops from this pyramid level, 0 being native "
+        "resolution; it has to be one of --pyramid_levels, e.g. "
+        "--crop_level 0 --pyramid_levels 0 1 2 3",
+    )
+    parser.add_argument("--crop_jitter", type=float, default=0.75)
+    parser.add_argument(
+        "--decoder",
+        type=str,
+        choices=LandmarkDecoders.get_decoder_names(),
+        default=LandmarkDecoders.default,
+    )
+    parser.add_argument("--compare_decoders", action=argparse.BooleanOptionalAction)
+    parser.add_argument("--sparse_loss", action=argparse.BooleanOptionalAction)
+    parser.add_argument("--background_samples", type=int, default=4096)
     parser.add_argument("--num_runs", type=int, default=1)
+    parser.add_argument("--folds", type=int, default=None)
     parser.add_argument("--max_hours_per_run", type=int, default=5)
     parser.add_argument("--logger", action="store_true")
     parser.add_argument("--no-logger", action="store_false", dest="logger")
@@ -49,28 +111,169 @@ def get_model_name(module: L.LightningModule) -> str:
     return module.model.__class__.__name__
 
 
-def run(args: dict, seed: int = 42) -> dict:
-    set_seed(seed)
+def split_file(
+    args: Namespace,
+    csv_file: str,
+    fold: int = None,
+) -> str | None:
+    """
+    The split file of a dataset, or None if splits are not saved,
+    which they are only with --split_file. With --folds, every fold
+    gets a file of its own next to --split_file, as the folds have
+    different splits, and so does every one of --extra_datasets.
+    """
+    if args.split_file is None:
+        return None
+
+    name, extension = os.path.splitext(args.split_file)
+    fold_name = f"-fold{fold}of{args.folds}" if fold is not None else ""
+
+    if csv_file != args.csv_file:
+        name = f"{name}-{os.path.splitext(os.path.basename(csv_file))[0]}"
+
+    return f"{name}{fold_name}{extension}"
 
+
+def get_source_datamodule(
+    args: Namespace,
+    root_dir: str,
+    csv_file: str,
+) -> LateralSkullRadiographDataModule:
     model_type = ModelTypes.get_model_type(args.model_name)
 
-    datamodule = LateralSkullRadiographDataModule(
-        root_dir=args.root_dir,
-        csv_file=args.csv_file,
+    if args.crop_level is not None and not model_type.fully_convolutional:
+        raise ValueError(
+            f"{args.model_name} only works at {model_type.resized_image_size}, "
+            "crop training needs a fully convolutional model"
+        )
+
+    return LateralSkullRadiographDataModule(
+        root_dir=root_dir,
+        csv_file=csv_file,
         splits=args.splits,
         batch_size=args.batch_size,
         resized_image_size=model_type.resized_image_size,
         flip_augmentations=args.flip_augmentations,
+        color_augmentations=args.color_augmentations,
+        decode_workers=args.decode_workers,
+        draft_decoding=args.draft_decoding,
+        lazy_loading=args.lazy_loading,
+        image_cache_bytes=args.image_cache_mb * 1024 ** 2,
+        pyramid_levels=args.pyramid_levels,
+        cache_dir=args.cache_dir,
+        cache_max_bytes=(
+            int(args.cache_max_gb * 1024 ** 3)
+            if args.cache_max_gb is not None else None
+        ),
+        shared_memory=args.shared_memory,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor,
+        persistent_workers=args.persistent_workers,
+        train_shards=args.train_shards,
+        shuffle_buffer=args.shuffle_buffer,
+        device_resident=args.device_resident,
+        hard_example_sampling=args.hard_example_sampling,
+        uniform_fraction=args.uniform_fraction,
+        samples_per_epoch=args.samples_per_epoch,
+        crop_level=args.crop_level,
+        crop_jitter=args.crop_jitter,
+    )
+
+
+def get_datamodule(
+    args: Namespace,
+) -> LateralSkullRadiographDataModule | CompositeDataModule:
+    """
+    One DataModule for all runs and folds. It loads no images up
+    front; every run only switches its splits, so images loaded by
+    earlier runs are reused. With --extra_datasets, given as
+    root_dir:csv_file, all datasets are combined by a
+    CompositeDataModule.
+    """
+    datamodule = get_source_datamodule(args, args.root_dir, args.csv_file)
+
+    if len(args.extra_datasets) == 0:
+        return datamodule
+
+    datamodules = [datamodule] + [
+        get_source_datamodule(args, *extra_dataset.rsplit(":", 1))
+        for extra_dataset in args.extra_datasets
+    ]
+
+    point_id_maps = None
+
+    if args.point_id_maps is not None:
+        with open(args.point_id_maps, "r") as file:
+            point_id_maps_by_csv = json.load(file)
+
+        point_id_maps = [
+            point_id_maps_by_csv.get(source.dataset.csv_file, {})
+            for source in datamodules
+        ]
+
+    return CompositeDataModule(
+        datamodules,
+        weights=args.dataset_weights,
+        point_id_maps=point_id_maps,
+        samples_per_epoch=args.samples_per_epoch,
+    )
+
+
+def get_splits(
+    args: Namespace,
+    datamodule: LateralSkullRadiographDataModule,
+    seed: int,
+    fold: int = None,
+) -> dict[str, list[int]]:
+    csv_file = datamodule.dataset.csv_file
+
+    if fold is None:
+        return datamodule.random_splits(
+            args.splits,
+            split_file(args, csv_file),
+        )
+
+    return datamodule.kfold_splits(
+        args.folds,
+        fold,
+        args.splits,
+        seed,
+        split_file(args, csv_file, fold),
     )
 
+
+def run(
+    args: dict,
+    datamodule: LateralSkullRadiographDataModule | CompositeDataModule,
+    seed: int = 42,
+    fold: int = None,
+) -> dict:
+    set_seed(seed)
+
+    model_type = ModelTypes.get_model_type(args.model_name)
+
+    if isinstance(datamodule, CompositeDataModule):
+        datamodule.set_splits([
+            get_splits(args, source, seed, fold)
+            for source in datamodule.datamodules
+        ], seed)
+        dataset = datamodule
+    else:
+        datamodule.set_splits(get_splits(args, datamodule, seed, fold), seed)
+        dataset = datamodule.dataset
+
     model_args = {
         "model_name": args.model_name,
-        "point_ids": datamodule.dataset.point_ids,
-        "output_size": datamodule.dataset.num_points,
-        "original_image_size": datamodule.dataset.original_image_size,
-        "original_image_size_mm": datamodule.dataset.original_image_size_mm,
-        "resized_image_size": model_type.resized_image_size,
+        "point_ids": dataset.point_ids,
+        "output_size": dataset.num_points,
+        "original_image_size": dataset.original_image_size,
+        "original_image_size_mm": dataset.original_image_size_mm,
+        "resized_image_size": datamodule.eval_image_size,
         "batch_size": args.batch_size,
+        "decoder": args.decoder,
+        "compare_decoders": bool(args.compare_decoders),
+        "sparse_loss": bool(args.sparse_loss),
+        "background_samples": args.background_samples,
     }
 
     model = model_type.initialize(**model_args)
@@ -93,7 +296,7 @@ def run(args: dict, seed: int = 42) -> dict:
 
     image_logger = ImagePredictionLogger(
         num_samples=5,
-        resized_image_size=model_type.resized_image_size,
+        resized_image_size=datamodule.eval_image_size,
         model_name=args.model_name,
         dataset_name=args.csv_file,
     )
@@ -115,6 +318,9 @@ def run(args: dict, seed: int = 42) -> dict:
         early_stopping_callback,
         image_logger,
         stats_monitor,
+        SampleLossLogger(),
+        ImageCacheLogger(),
+        ShardEpochCallback(),
     ]
 
     trainer_args = {
@@ -159,24 +365,34 @@ def set_checkpoint_for_run(args: Namespace, run_idx: int) -> str:
 
 
 if __name__ == "__main__":
+    mp.set_start_method("spawn")
+
     args = get_args()
 
+    datamodule = get_datamodule(args)
+
+    folds = range(args.folds) if args.folds is not None else [None]
+
     all_results = []
 
     for run_idx in range(args.num_runs):
-        start_time = time.time()
+        for fold in folds:
+            start_time = time.time()
+
+            run_args = set_checkpoint_for_run(args, len(all_results))
 
-        run_args = set_checkpoint_for_run(args, run_idx)
+            results = run(run_args, datamodule, seed=run_idx, fold=fold)[0]
 
-        results = run(run_args, seed=run_idx)[0]
+            end_time = time.time()
+            seconds_to_hours = 3600
+            training_time = (end_time - start_time) / seconds_to_hours
+            results.update({"training_time": training_time})
 
-        end_time = time.time()
-        seconds_to_hours = 3600
-        training_time = (end_time - start_time) / seconds_to_hours
-        results.update({"training_time": training_time})
+            if fold is not None:
+                print(f"Run {run_idx}, fold {fold}:")
 
-        print(results)
+            print(results)
 
-        all_results.append(results)
+            all_results.append(results)
 
     print_mean_std(all_results)
@@ -0,0 +1,83 @@
+import argparse
+import time
+import pandas as pd
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from dataset.decode_image import find_image_path, decode_image
+
+# The resized_image_size values used by ModelTypes
+RESIZED_IMAGE_SIZES = [(224, 224), (384, 384), (512, 512), (640, 640), (800, 640)]
+
+
+def get_args() -> dict:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root_dir", type=str, default="dataset/benchmark")
+    parser.add_argument("--csv_file", type=str, default="points.csv")
+    parser.add_argument("--num_images", type=int, default=20)
+
+    return parser.parse_args()
+
+
+def decode_reference(path: str, resized_image_size: tuple[int, int]) -> torch.Tensor:
+    """
+    The original loading path: full resolution float RGB decode,
+    then resize. Only the first channel is kept since all three
+    are identical for grayscale radiographs.
+    """
+    image = transforms.ToTensor()(Image.open(path).convert('RGB'))
+    image = transforms.Resize(resized_image_size)(image)
+
+    return image[:1]
+
+
+def time_decode(decode, paths: list[str]) -> tuple[list[torch.Tensor], float]:
+    start_time = time.time()
+    images = [decode(path) for path in paths]
+    seconds_per_image = (time.time() - start_time) / len(paths)
+
+    return images, seconds_per_image
+
+
+def compare(paths: list[str], resized_image_size: tuple[int, int]) -> None:
+    reference, reference_time = time_decode(
+        lambda path: decode_reference(path, resized_image_size),
+        paths,
+    )
+
+    for draft in [False, True]:
+        images, seconds_per_image = time_decode(
+            lambda path: torch.from_numpy(
+                decode_image(path, resized_image_size, draft=draft)
+            ),
+            paths,
+        )
+
+        difference = torch.stack([
+            (image.float() - (ref * 255)).abs()
+            for image, ref in zip(images, reference)
+        ])
+
+        mse = (difference ** 2).mean()
+        psnr = 10 * torch.log10(255 ** 2 / mse)
+
+        print(
+            f"{resized_image_size} draft={draft}: "
+            f"{seconds_per_image * 1000:.1f} ms/image "
+            f"(reference {reference_time * 1000:.1f} ms/image), "
+            f"mean abs diff {difference.mean():.3f}, "
+            f"max abs diff {difference.max():.1f}, "
+            f"PSNR {psnr:.1f} dB"
+        )
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    data_frame = pd.read_csv(f"{args.root_dir}/{args.csv_file}", dtype=str)
+    documents = data_frame['document'].drop_duplicates()[:args.num_images]
+    paths = [find_image_path(args.root_dir, document) for document in documents]
+
+    for resized_image_size in RESIZED_IMAGE_SIZES:
+        compare(paths, resized_image_size)
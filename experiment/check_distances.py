@@ -18,6 +18,7 @@ data_module = LateralSkullRadiographDataModule(
     resized_image_size=resized_image_size,
     flip_augmentations=False,
 )
+data_module.setup('fit')
 
 original_image_size_mm = data_module.dataset.original_image_size_mm
 original_image_size = data_module.dataset.original_image_size
@@ -49,11 +50,16 @@ mre = MeanRadialError(
 
 for i in range(20):
     plt.figure(figsize=(30, 24))
-    image, targets = next(iter(data_module.train_dataloader()))
+    image, targets = data_module.on_after_batch_transfer(
+        data_module.transfer_batch_to_device(
+            next(iter(data_module.train_dataloader())), device, 0
+        ),
+        0,
+    )
     predictions = model(image)
     distance = mre(predictions, targets)
 
-    plt.imshow(image[0].cpu().permute(1, 2, 0))
+    plt.imshow(image[0, 0].cpu(), cmap='gray')
     plt.scatter(targets[0, :, 0].cpu(), targets[0, :, 1].cpu(), c='r')
     plt.scatter(predictions[0, :, 0].cpu(), predictions[0, :, 1].cpu(), c='b')
 
@@ -0,0 +1,80 @@
+import argparse
+import time
+import torch
+
+from dataset.LateralSkullRadiographDataModule import LateralSkullRadiographDataModule
+
+
+def get_args() -> dict:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root_dir", type=str, default="dataset/benchmark")
+    parser.add_argument("--csv_file", type=str, default="points.csv")
+    parser.add_argument("--resized_image_size", nargs=2, type=int, default=[224, 224])
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--device", type=str, default=(
+        "cuda" if torch.cuda.is_available() else "cpu"
+    ))
+
+    return parser.parse_args()
+
+
+def steps_per_second(
+    datamodule: LateralSkullRadiographDataModule,
+    device: torch.device,
+    epochs: int,
+) -> float:
+    """
+    Steps per second of drawing training batches, moving them to the
+    device and preparing them the way the trainer does, without a
+    model. The first epoch is a warm-up and not measured.
+    """
+    dataloader = datamodule.train_dataloader()
+    steps = 0
+
+    for epoch in range(epochs + 1):
+        if epoch == 1:
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+
+            start_time = time.time()
+
+        for batch in dataloader:
+            batch = datamodule.transfer_batch_to_device(batch, device, 0)
+            images, points = datamodule.on_after_batch_transfer(batch, 0)
+
+            if epoch > 0:
+                steps += 1
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+    return steps / (time.time() - start_time)
+
+
+if __name__ == "__main__":
+    args = get_args()
+    device = torch.device(args.device)
+
+    for device_resident in [False, True]:
+        datamodule = LateralSkullRadiographDataModule(
+            root_dir=args.root_dir,
+            csv_file=args.csv_file,
+            resized_image_size=tuple(args.resized_image_size),
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            persistent_workers=True,
+            device_resident=device_resident,
+        )
+
+        datamodule.load_stage("fit")
+
+        if device_resident:
+            datamodule.to_device(device, "fit")
+
+        print(
+            f"device_resident={device_resident}: "
+            f"{steps_per_second(datamodule, device, args.epochs):.1f} steps/s "
+            f"({args.batch_size} images of {tuple(args.resized_image_size)} per step)"
+        )
@@ -0,0 +1,144 @@
+import argparse
+from argparse import Namespace
+import torch
+
+from models.losses.HeatmapOffsetmapLoss import HeatmapOffsetmapLoss
+
+
+def get_args() -> dict:
+    parser = argparse.ArgumentParser(
+        description="Check that landmarks marked missing with -1, like the "
+        "points LandmarkCropDataset moves outside of a crop, add no target "
+        "and no gradient to HeatmapOffsetmapLoss, and that its sparse mode, "
+        "sampling every background pixel, matches the dense loss with "
+        "missing landmarks."
+    )
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--num_points", type=int, default=5)
+    parser.add_argument("--image_size", nargs=2, type=int, default=[128, 96])
+    parser.add_argument("--radius", type=int, default=10)
+    parser.add_argument("--tolerance", type=float, default=1e-5)
+    parser.add_argument("--device", type=str, default=(
+        "cuda" if torch.cuda.is_available() else "cpu"
+    ))
+
+    return parser.parse_args()
+
+
+def random_batch(
+    args: Namespace,
+    generator: torch.Generator,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Random model outputs and landmarks, with the last landmark of
+    every image missing, and every landmark of the last image.
+    """
+    height, width = args.image_size
+
+    feature_maps = torch.randn(
+        args.batch_size,
+        3 * args.num_points,
+        height,
+        width,
+        generator=generator,
+    )
+    landmarks = torch.rand(args.batch_size, args.num_points, 2, generator=generator) \
+        * torch.tensor([width - 2, height - 2]) + 1
+
+    landmarks[:, -1] = -1
+    landmarks[-1] = -1
+
+    return feature_maps, landmarks
+
+
+def check_masking(args: Namespace, sparse: bool, device: torch.device) -> None:
+    height, width = args.image_size
+    feature_maps, landmarks = random_batch(args, torch.Generator().manual_seed(0))
+    feature_maps = feature_maps.to(device).requires_grad_()
+    landmarks = landmarks.to(device)
+
+    loss_function = HeatmapOffsetmapLoss(
+        args.image_size,
+        heatmap_radius=args.radius,
+        offsetmap_radius=args.radius,
+        sparse=sparse,
+    ).to(device)
+    missing = ~loss_function.valid_landmarks(landmarks)
+
+    heatmaps = loss_function.target_heatmaps(
+        loss_function.clamp_landmarks(landmarks, height, width),
+        height,
+        width,
+    )
+
+    if heatmaps[missing].any():
+        raise AssertionError("Missing landmarks have a target disc")
+
+    if not heatmaps[~missing].flatten(1).any(-1).all():
+        raise AssertionError("Annotated landmarks have no target disc")
+
+    loss, sample_losses = loss_function(feature_maps, landmarks, return_sample_losses=True)
+    loss.backward()
+
+    gradients = feature_maps.grad.view(args.batch_size, 3, args.num_points, height, width)
+
+    if gradients.transpose(1, 2)[missing].any():
+        raise AssertionError("Missing landmarks have a gradient")
+
+    if not gradients.transpose(1, 2)[~missing].flatten(1).any(-1).all():
+        raise AssertionError("Annotated landmarks have no gradient")
+
+    if sample_losses[-1] != 0:
+        raise AssertionError(
+            f"An image without landmarks has a loss of {sample_losses[-1]}"
+        )
+
+    print(f"{'sparse' if sparse else 'dense'} loss on {device}: missing landmarks masked")
+
+
+def check_parity(args: Namespace, device: torch.device) -> None:
+    """
+    With a background sample per pixel, the sparse loss sums the same
+    elementwise losses as the dense one, in another order.
+    """
+    height, width = args.image_size
+    feature_maps, landmarks = random_batch(args, torch.Generator().manual_seed(1))
+    feature_maps = feature_maps.to(device)
+    landmarks = landmarks.to(device)
+
+    results = {}
+
+    for sparse in [False, True]:
+        loss_function = HeatmapOffsetmapLoss(
+            args.image_size,
+            heatmap_radius=args.radius,
+            offsetmap_radius=args.radius,
+            sparse=sparse,
+            background_samples=height * width,
+        ).to(device)
+        inputs = feature_maps.clone().requires_grad_()
+
+        loss, sample_losses = loss_function(inputs, landmarks, return_sample_losses=True)
+        loss.backward()
+
+        results[sparse] = (loss.detach(), sample_losses, inputs.grad)
+
+    names = ["loss", "sample losses", "gradients"]
+
+    for name, dense, sparse in zip(names, results[False], results[True]):
+        deviation = (dense - sparse).abs().max().item()
+
+        if deviation > args.tolerance:
+            raise AssertionError(f"Sparse and dense {name} differ by {deviation}")
+
+    print(f"sparse loss on {device}: matches the dense loss with missing landmarks")
+
+
+if __name__ == "__main__":
+    args = get_args()
+    device = torch.device(args.device)
+
+    for sparse in [False, True]:
+        check_masking(args, sparse, device)
+
+    check_parity(args, device)
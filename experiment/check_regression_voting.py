@@ -0,0 +1,169 @@
+import argparse
+import time
+from argparse import Namespace
+import numpy as np
+import torch
+
+from utils.regression_voting import regression_voting, coarse_to_fine_voting
+
+
+def get_args() -> dict:
+    parser = argparse.ArgumentParser(
+        description="Check that the batched regression voting decodes the "
+        "same points as the former per-landmark loop, that the coarse-to-fine "
+        "voting stays within tolerance of it, and compare their speed."
+    )
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--num_points", nargs="+", type=int, default=[19, 37])
+    parser.add_argument("--image_size", nargs=2, type=int, default=[800, 640])
+    parser.add_argument("--radius", type=int, default=40)
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--trials", type=int, default=3)
+    parser.add_argument("--device", type=str, default=(
+        "cuda" if torch.cuda.is_available() else "cpu"
+    ))
+
+    return parser.parse_args()
+
+
+def reference_regression_voting(heatmaps, R):
+    """
+    The former HeatmapBasedLandmarkDetection.regression_voting.
+    """
+    topN = int(R * R * 3.1415926)
+    heatmap = heatmaps
+    imageNum, featureNum, h, w = heatmap.size()
+    landmarkNum = int(featureNum / 3)
+    heatmap = heatmap.contiguous().view(imageNum, featureNum, -1)
+
+    predicted_landmarks = torch.zeros((imageNum, landmarkNum, 2), device=heatmaps.device)
+    Pmap = heatmap[:, 0:landmarkNum, :].data
+    Xmap = torch.round(heatmap[:, landmarkNum : landmarkNum * 2, :].data * R).long() * w
+    Ymap = torch.round(heatmap[:, landmarkNum * 2 : landmarkNum * 3, :].data * R).long()
+    topkP, indexs = torch.topk(Pmap, topN)
+
+    for imageId in range(imageNum):
+        for landmarkId in range(landmarkNum):
+
+            topnXoff = Xmap[imageId][landmarkId][
+                indexs[imageId][landmarkId]
+            ]  # offset in x direction
+
+            topnYoff = Ymap[imageId][landmarkId][
+                indexs[imageId][landmarkId]
+            ]  # offset in y direction
+
+            VotePosi = (
+                (topnXoff + topnYoff + indexs[imageId][landmarkId])
+                .cpu()
+                .numpy()
+                .astype("int")
+            )
+
+            tem = VotePosi[VotePosi >= 0]
+            maxid = 0
+
+            if len(tem) > 0:
+                maxid = np.argmax(np.bincount(tem))
+
+            x = maxid // w
+            y = maxid - x * w
+            predicted_landmarks[imageId][landmarkId] = torch.tensor([y, x], device=heatmaps.device)
+    return predicted_landmarks
+
+
+def model_outputs(
+    batch_size: int,
+    num_points: int,
+    image_size: tuple[int, int],
+    radius: int,
+    generator: torch.Generator,
+) -> torch.Tensor:
+    """
+    Outputs shaped like a trained model's: a blob per heatmap and
+    offset maps pointing at a landmark, with noise, so that there
+    are ties and votes outside of the image. The last landmark only
+    votes outside of the image.
+    """
+    height, width = image_size
+    rows = torch.arange(height).view(1, 1, -1, 1).float()
+    columns = torch.arange(width).view(1, 1, 1, -1).float()
+
+    landmark_rows = torch.randint(height, (batch_size, num_points, 1, 1), generator=generator)
+    landmark_columns = torch.randint(width, (batch_size, num_points, 1, 1), generator=generator)
+
+    heatmaps = -((rows - landmark_rows) ** 2 + (columns - landmark_columns) ** 2) \
+        / radius ** 2 + 0.1 * torch.randn(batch_size, num_points, height, width, generator=generator)
+    row_offsets = (landmark_rows - rows) / radius \
+        + 0.05 * torch.randn(batch_size, num_points, height, width, generator=generator)
+    column_offsets = (landmark_columns - columns) / radius \
+        + 0.05 * torch.randn(batch_size, num_points, height, width, generator=generator)
+
+    row_offsets[:, -1] = -2 * height
+
+    return torch.cat([heatmaps, row_offsets, column_offsets], dim=1)
+
+
+def timed(decode, heatmaps: torch.Tensor, radius: int) -> tuple[torch.Tensor, float]:
+    if heatmaps.device.type == "cuda":
+        torch.cuda.synchronize()
+
+    start_time = time.time()
+    points = decode(heatmaps, radius)
+
+    if heatmaps.device.type == "cuda":
+        torch.cuda.synchronize()
+
+    return points, time.time() - start_time
+
+
+def compare(args: Namespace, num_points: int, device: torch.device) -> None:
+    generator = torch.Generator().manual_seed(0)
+    seconds = {"loop": 0, "batched": 0, "coarse-to-fine": 0}
+    max_deviation = 0
+
+    for trial in range(args.trials):
+        heatmaps = model_outputs(
+            args.batch_size,
+            num_points,
+            args.image_size,
+            args.radius,
+            generator,
+        ).to(device)
+
+        expected, elapsed = timed(reference_regression_voting, heatmaps, args.radius)
+        seconds["loop"] += elapsed
+
+        points, elapsed = timed(regression_voting, heatmaps, args.radius)
+        seconds["batched"] += elapsed
+
+        if not torch.equal(points, expected):
+            mismatches = (points != expected).any(-1).nonzero().tolist()
+            raise AssertionError(f"Trial {trial}: points differ at {mismatches}")
+
+        points, elapsed = timed(coarse_to_fine_voting, heatmaps, args.radius)
+        seconds["coarse-to-fine"] += elapsed
+
+        max_deviation = max(max_deviation, (points - expected).abs().max().item())
+
+    if max_deviation > args.tolerance:
+        raise AssertionError(
+            f"Coarse-to-fine points deviate by up to {max_deviation} pixels"
+        )
+
+    print(
+        f"{num_points} points, {args.batch_size}x{args.image_size[0]}x"
+        f"{args.image_size[1]} on {device}: batched identical, coarse-to-fine "
+        f"within {max_deviation:.2f} pixels in {args.trials} trials"
+    )
+
+    for name, total in seconds.items():
+        print(f"  {name}: {total / args.trials * 1000:.1f} ms per batch")
+
+
+if __name__ == "__main__":
+    args = get_args()
+    device = torch.device(args.device)
+
+    for num_points in args.num_points:
+        compare(args, num_points, device)
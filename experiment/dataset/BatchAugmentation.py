@@ -0,0 +1,209 @@
+import torch
+
+
+class BatchAugmentation:
+    """
+    Augments whole batches on the device they were transferred to.
+    Every sample draws its own parameters, with the same
+    distributions as the former per-sample pipeline:
+    - ColorJitter(brightness=0.5, contrast=0.5) with brightness and
+      contrast applied in random order (saturation has no effect on
+      grayscale radiographs)
+    - GaussNoise(var_limit=noise_variance, p=noise_probability)
+    - horizontal and vertical flips with flip_probability each,
+      invalid points being set to -1 once a sample is flipped
+    Each batch uses a generator seeded from seed and the number of
+    batches augmented so far, so runs with the same seed see the
+    same augmentations.
+    """
+    def __init__(
+        self,
+        flip: bool = True,
+        color: bool = False,
+        brightness: float = 0.5,
+        contrast: float = 0.5,
+        noise_variance: float = 0.2,
+        noise_probability: float = 0.5,
+        flip_probability: float = 0.5,
+        seed: int = 0,
+    ):
+        self.flip = flip
+        self.color = color
+        self.brightness = brightness
+        self.contrast = contrast
+        self.noise_variance = noise_variance
+        self.noise_probability = noise_probability
+        self.flip_probability = flip_probability
+        self.seed = seed
+        self.num_batches = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.flip or self.color
+
+    def _generator(self, device: torch.device) -> torch.Generator:
+        generator = torch.Generator(device=device)
+        generator.manual_seed(self.seed * 1_000_003 + self.num_batches)
+        self.num_batches += 1
+
+        return generator
+
+    def _uniform(
+        self,
+        batch_size: int,
+        low: float,
+        high: float,
+        generator: torch.Generator,
+        device: torch.device,
+    ) -> torch.Tensor:
+        return low + (high - low) * torch.rand(
+            batch_size, 1, 1, 1, generator=generator, device=device
+        )
+
+    def _coin(
+        self,
+        batch_size: int,
+        probability: float,
+        generator: torch.Generator,
+        device: torch.device,
+    ) -> torch.Tensor:
+        return torch.rand(
+            batch_size, generator=generator, device=device
+        ) < probability
+
+    def _adjust_brightness(
+        self,
+        images: torch.Tensor,
+        factors: torch.Tensor
+    ) -> torch.Tensor:
+        return (images * factors).clamp(0, 1)
+
+    def _adjust_contrast(
+        self,
+        images: torch.Tensor,
+        factors: torch.Tensor
+    ) -> torch.Tensor:
+        mean = images.mean(dim=(-3, -2, -1), keepdim=True)
+
+        return (factors * images + (1 - factors) * mean).clamp(0, 1)
+
+    def _color_jitter(
+        self,
+        images: torch.Tensor,
+        generator: torch.Generator,
+    ) -> torch.Tensor:
+        batch_size, device = images.size(0), images.device
+
+        brightness = self._uniform(
+            batch_size,
+            max(0, 1 - self.brightness),
+            1 + self.brightness,
+            generator,
+            device,
+        )
+        contrast = self._uniform(
+            batch_size,
+            max(0, 1 - self.contrast),
+            1 + self.contrast,
+            generator,
+            device,
+        )
+        brightness_first = self._coin(batch_size, 0.5, generator, device) \
+            .view(-1, 1, 1, 1)
+
+        brightness_then_contrast = self._adjust_contrast(
+            self._adjust_brightness(images, brightness),
+            contrast,
+        )
+        contrast_then_brightness = self._adjust_brightness(
+            self._adjust_contrast(images, contrast),
+            brightness,
+        )
+
+        return torch.where(
+            brightness_first,
+            brightness_then_contrast,
+            contrast_then_brightness,
+        )
+
+    def _gauss_noise(
+        self,
+        images: torch.Tensor,
+        generator: torch.Generator,
+    ) -> torch.Tensor:
+        batch_size, device = images.size(0), images.device
+
+        apply = self._coin(
+            batch_size, self.noise_probability, generator, device
+        ).view(-1, 1, 1, 1)
+        sigma = self._uniform(
+            batch_size, 0, self.noise_variance, generator, device
+        ).sqrt()
+
+        noise = torch.randn(
+            images.shape, generator=generator, device=device
+        ) * sigma
+
+        return torch.where(apply, (images + noise).clamp(0, 1), images)
+
+    def _flip(
+        self,
+        images: torch.Tensor,
+        points: torch.Tensor,
+        generator: torch.Generator,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        batch_size, device = images.size(0), images.device
+        height, width = images.shape[-2:]
+
+        horizontal = self._coin(
+            batch_size, self.flip_probability, generator, device
+        )
+        vertical = self._coin(
+            batch_size, self.flip_probability, generator, device
+        )
+
+        images = torch.where(
+            horizontal.view(-1, 1, 1, 1), images.flip(-1), images
+        )
+        images = torch.where(
+            vertical.view(-1, 1, 1, 1), images.flip(-2), images
+        )
+
+        x = torch.where(
+            horizontal.view(-1, 1), width - points[..., 0], points[..., 0]
+        )
+        y = torch.where(
+            vertical.view(-1, 1), height - points[..., 1], points[..., 1]
+        )
+        flipped_points = torch.stack([x, y], dim=-1)
+
+        invalid_points = (points <= 0).any(-1) \
+            & (horizontal | vertical).view(-1, 1)
+
+        flipped_points[invalid_points] = -1
+
+        return images, flipped_points
+
+    def __call__(
+        self,
+        images: torch.Tensor,
+        points: torch.Tensor,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        images are float tensors in [0, 1] of shape
+        (batch_size, channels, height, width), points have shape
+        (batch_size, num_points, 2) in (x, y) pixel coordinates.
+        """
+        if not self.enabled:
+            return images, points
+
+        generator = self._generator(images.device)
+
+        if self.color:
+            images = self._color_jitter(images, generator)
+            images = self._gauss_noise(images, generator)
+
+        if self.flip:
+            images, points = self._flip(images, points, generator)
+
+        return images, points
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+
+CACHE_VERSION = 1
+
+
+def default_cache_dir() -> str:
+    return os.environ.get(
+        'CEPHALOMETRY_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'cephalometry'),
+    )
+
+
+class CacheDirectory:
+    """
+    A central directory of dataset caches. Every entry is a
+    subdirectory named after a hash of the dataset it caches (its
+    root directory and CSV file) and the preprocessing parameters.
+    Within an entry, cached rows are keyed by the contents of their
+    CSV row and the size and modification time of their image (see
+    IncrementalImageCache), so edited annotations or replaced images
+    are detected and decoded again instead of silently serving stale
+    data. When the total size exceeds max_bytes, the least recently
+    used entries are evicted.
+    """
+    entry_file = 'entry.json'
+
+    def __init__(self, root: str = None, max_bytes: int = None):
+        self.root = root if root is not None else default_cache_dir()
+        self.max_bytes = max_bytes
+
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def key(
+        root_dir: str,
+        csv_file: str,
+        params: dict,
+    ) -> str:
+        return hashlib.sha256(json.dumps(
+            {
+                'version': CACHE_VERSION,
+                'root_dir': os.path.abspath(root_dir),
+                'csv_file': csv_file,
+                **params,
+            },
+            sort_keys=True,
+        ).encode()).hexdigest()[:32]
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(os.path.join(self.path(key), self.entry_file))
+
+    def touch(self, key: str) -> None:
+        os.utime(os.path.join(self.path(key), self.entry_file))
+
+    def entry(self, key: str, metadata: dict) -> str:
+        """
+        The directory of an entry, created if it does not exist yet.
+        Opening an entry marks it as recently used.
+        """
+        path = self.path(key)
+        entry_path = os.path.join(path, self.entry_file)
+
+        if not os.path.exists(entry_path):
+            os.makedirs(path, exist_ok=True)
+            self._write_entry(key, {'created': time.time(), **metadata})
+
+        self.touch(key)
+
+        return path
+
+    def update(self, key: str) -> None:
+        """
+        Record the new size of an entry after data was added to it
+        and evict other entries if the cache exceeds its budget.
+        """
+        with open(os.path.join(self.path(key), self.entry_file), 'r') as file:
+            entry = json.load(file)
+
+        self._write_entry(key, entry)
+
+        if self.max_bytes is not None:
+            self.prune(self.max_bytes, keep=[key])
+
+    def _write_entry(self, key: str, entry: dict) -> None:
+        path = self.path(key)
+        entry_path = os.path.join(path, self.entry_file)
+        temporary_path = f'{entry_path}.tmp-{os.getpid()}'
+
+        with open(temporary_path, 'w') as file:
+            json.dump({
+                **entry,
+                'key': key,
+                'nbytes': self._directory_size(path),
+            }, file, indent=2)
+
+        os.replace(temporary_path, entry_path)
+
+    def entries(self) -> list[dict]:
+        """
+        All complete entries, least recently used first.
+        """
+        entries = []
+
+        for key in os.listdir(self.root):
+            entry_path = os.path.join(self.root, key, self.entry_file)
+
+            if key.startswith('.') or not os.path.exists(entry_path):
+                continue
+
+            with open(entry_path, 'r') as file:
+                entry = json.load(file)
+
+            entry['last_used'] = os.path.getmtime(entry_path)
+            entries.append(entry)
+
+        return sorted(entries, key=lambda entry: entry['last_used'])
+
+    @property
+    def nbytes(self) -> int:
+        return sum(entry['nbytes'] for entry in self.entries())
+
+    def remove(self, key: str) -> None:
+        shutil.rmtree(self.path(key), ignore_errors=True)
+
+    def prune(self, max_bytes: int, keep: list[str] = ()) -> list[dict]:
+        """
+        Evict least recently used entries until the cache fits into
+        max_bytes. Entries in keep are never evicted.
+        """
+        entries = self.entries()
+        total = sum(entry['nbytes'] for entry in entries)
+        evicted = []
+
+        for entry in entries:
+            if total <= max_bytes:
+                break
+
+            if entry['key'] in keep:
+                continue
+
+            self.remove(entry['key'])
+            total -= entry['nbytes']
+            evicted.append(entry)
+
+        return evicted
+
+    @staticmethod
+    def _directory_size(path: str) -> int:
+        return sum(
+            os.path.getsize(os.path.join(directory, name))
+            for directory, _, names in os.walk(path)
+            for name in names
+        )
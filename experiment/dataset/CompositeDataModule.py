@@ -0,0 +1,210 @@
+import lightning as L
+import torch
+from torch.utils.data import DataLoader, WeightedRandomSampler
+
+from dataset.CompositeDataset import CompositeDataset
+from dataset.LateralSkullRadiographDataModule import LateralSkullRadiographDataModule
+
+
+class CompositeDataModule(L.LightningDataModule):
+    """
+    Trains on several datasets at once without merging their CSVs or
+    caches. Every source keeps its own LateralSkullRadiographDataModule,
+    with its own cache, splits and loading; the splits are combined by
+    reference into CompositeDatasets.
+    point_id_maps optionally rename the landmark ids of each source,
+    e.g. {'0': 'sella'}; the shared landmarks are the union of all
+    (renamed) ids, in order of appearance. Training samples are drawn
+    with replacement so that each source makes up its share of
+    weights of every epoch, whatever its size. Batches carry the
+    image size in mm of every sample's source as a third element.
+    Loader settings and augmentations are those of the first source.
+    """
+    def __init__(
+        self,
+        datamodules: list[LateralSkullRadiographDataModule],
+        weights: list[float] = None,
+        point_id_maps: list[dict[str, str]] = None,
+        samples_per_epoch: int = None,
+    ):
+        super().__init__()
+
+        self.datamodules = datamodules
+        self.weights = weights if weights is not None else [1.0] * len(datamodules)
+        self.samples_per_epoch = samples_per_epoch
+
+        if len(self.weights) != len(datamodules):
+            raise ValueError(
+                f'Got {len(self.weights)} weights for {len(datamodules)} datasets'
+            )
+
+        if any(datamodule.hard_example_sampling for datamodule in datamodules):
+            raise ValueError(
+                'Hard example sampling does not work with several datasets, '
+                'whose samples are drawn by dataset weight'
+            )
+
+        if any(
+            datamodule.device_resident or datamodule.train_shards is not None
+            for datamodule in datamodules
+        ):
+            raise ValueError(
+                'Several datasets are read sample by sample through their '
+                'datasets and work with neither train_shards nor device_resident'
+            )
+
+        if point_id_maps is None:
+            point_id_maps = [{}] * len(datamodules)
+
+        source_point_ids = [
+            [point_id_map.get(point_id, point_id) for point_id in datamodule.dataset.point_ids]
+            for datamodule, point_id_map in zip(datamodules, point_id_maps)
+        ]
+
+        self.point_ids = list(dict.fromkeys(
+            point_id for point_ids in source_point_ids for point_id in point_ids
+        ))
+        self.point_maps = [
+            torch.tensor([self.point_ids.index(point_id) for point_id in point_ids])
+            for point_ids in source_point_ids
+        ]
+
+        self.seed = self.primary.seed
+        self.train_dataset, self.val_dataset, self.test_dataset = [
+            self._composite(name) for name in LateralSkullRadiographDataModule.split_names
+        ]
+
+    @property
+    def primary(self) -> LateralSkullRadiographDataModule:
+        return self.datamodules[0]
+
+    @property
+    def num_points(self) -> int:
+        return len(self.point_ids)
+
+    @property
+    def resized_image_size(self) -> tuple[int, int]:
+        return self.primary.resized_image_size
+
+    @property
+    def eval_image_size(self) -> tuple[int, int]:
+        return self.primary.eval_image_size
+
+    @property
+    def original_image_size(self) -> tuple[int, int]:
+        """
+        Models are built with the image sizes of the first source;
+        mm errors use the size of every sample's own source.
+        """
+        return self.primary.dataset.original_image_size
+
+    @property
+    def original_image_size_mm(self) -> tuple[float, float]:
+        return self.primary.dataset.original_image_size_mm
+
+    def _composite(self, name: str) -> CompositeDataset:
+        return CompositeDataset(
+            [getattr(datamodule, f'{name}_dataset') for datamodule in self.datamodules],
+            self.point_maps,
+            self.num_points,
+            [datamodule.dataset.original_image_size_mm for datamodule in self.datamodules],
+        )
+
+    def set_splits(self, rows: list[dict[str, list[int]]], seed: int) -> None:
+        """
+        Switch every source to its next splits, see
+        LateralSkullRadiographDataModule.set_splits.
+        """
+        for datamodule, source_rows in zip(self.datamodules, rows):
+            datamodule.set_splits(source_rows, seed)
+
+        self.seed = seed
+        self.train_dataset, self.val_dataset, self.test_dataset = [
+            self._composite(name) for name in LateralSkullRadiographDataModule.split_names
+        ]
+
+    def setup(self, stage: str) -> None:
+        for datamodule in self.datamodules:
+            datamodule.load_stage(stage)
+
+    def _train_sampler(self) -> WeightedRandomSampler:
+        sample_weights = torch.cat([
+            torch.full((len(dataset),), weight / max(len(dataset), 1))
+            for dataset, weight in zip(self.train_dataset.datasets, self.weights)
+        ])
+
+        generator = torch.Generator()
+        generator.manual_seed(self.seed)
+
+        return WeightedRandomSampler(
+            sample_weights,
+            num_samples=self.samples_per_epoch or len(self.train_dataset),
+            replacement=True,
+            generator=generator,
+        )
+
+    def train_dataloader(self) -> DataLoader:
+        return DataLoader(
+            self.train_dataset,
+            sampler=self._train_sampler(),
+            **self.primary._dataloader_args(),
+        )
+
+    def val_dataloader(self) -> DataLoader:
+        return DataLoader(
+            self.val_dataset,
+            **self.primary._dataloader_args(),
+        )
+
+    def test_dataloader(self) -> DataLoader:
+        return DataLoader(
+            self.test_dataset,
+            **self.primary._dataloader_args(),
+        )
+
+    def image_cache_stats(self) -> dict[str, float]:
+        """
+        The image cache stats of every source, prefixed with the CSV
+        file of the source.
+        """
+        return {
+            f'{datamodule.dataset.csv_file}_{name}': value
+            for datamodule in self.datamodules
+            for name, value in datamodule.image_cache_stats().items()
+        }
+
+    def on_after_batch_transfer(
+        self,
+        batch: tuple[torch.Tensor, torch.Tensor, torch.Tensor],
+        dataloader_idx: int,
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        return self.primary.prepare_batch(
+            batch,
+            augment=self.trainer is not None and self.trainer.training,
+        )
+
+    def preview_batch(
+        self,
+        num_samples: int,
+        device: torch.device,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        num_samples validation samples, taken evenly from all sources
+        and prepared the same way as a validation batch.
+        """
+        samples_per_source = -(-num_samples // len(self.datamodules))
+
+        samples = [
+            self.val_dataset[offset + index]
+            for offset, dataset in zip(
+                [0] + self.val_dataset.cumulative_sizes[:-1],
+                self.val_dataset.datasets,
+            )
+            for index in range(min(samples_per_source, len(dataset)))
+        ]
+
+        batch = torch.utils.data.default_collate(samples)
+        batch = self.transfer_batch_to_device(batch, device, 0)
+        images, points, _ = self.primary.prepare_batch(batch, augment=False)
+
+        return images, points
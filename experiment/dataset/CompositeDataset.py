@@ -0,0 +1,51 @@
+import bisect
+import torch
+from torch.utils.data import ConcatDataset, Dataset
+
+
+class CompositeDataset(ConcatDataset):
+    """
+    Several datasets indexed as one, by reference. The landmarks of
+    every source are scattered into a shared set of num_points
+    landmarks through point_maps, the index of each source landmark
+    in the shared set. Landmarks a source does not annotate are set
+    to -1 and thereby masked like missing points. Every sample also
+    carries the (height, width) in mm of its source's images, so that
+    mm errors are computed with the right scale per sample.
+    """
+    def __init__(
+        self,
+        datasets: list[Dataset],
+        point_maps: list[torch.Tensor],
+        num_points: int,
+        image_sizes_mm: list[tuple[float, float]],
+    ):
+        super().__init__(datasets)
+
+        self.point_maps = point_maps
+        self.num_points = num_points
+        self.image_sizes_mm = [
+            torch.tensor(image_size_mm, dtype=torch.float32)
+            for image_size_mm in image_sizes_mm
+        ]
+
+    def source(self, index: int) -> tuple[int, int]:
+        """
+        The source dataset of an index and the index within it.
+        """
+        dataset_index = bisect.bisect_right(self.cumulative_sizes, index)
+        offset = self.cumulative_sizes[dataset_index - 1] if dataset_index > 0 else 0
+
+        return dataset_index, index - offset
+
+    def __getitem__(
+        self,
+        index: int,
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        dataset_index, sample_index = self.source(index)
+        image, points = self.datasets[dataset_index][sample_index]
+
+        shared_points = torch.full((self.num_points, 2), -1.0)
+        shared_points[self.point_maps[dataset_index]] = points
+
+        return image, shared_points, self.image_sizes_mm[dataset_index]
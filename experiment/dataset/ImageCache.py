@@ -0,0 +1,118 @@
+import json
+import os
+import warnings
+import numpy as np
+import torch
+
+
+class ImageCache:
+    """
+    Stores equally sized uint8 images in one memory-mapped file.
+    A small json index next to the file records the image shape and
+    the documents the images were decoded from. Images are sliced out
+    of the memory map without copying, so only the pages that are
+    actually read end up in memory, and concurrent jobs reading the
+    same file share them through the page cache.
+    By default, the file is mapped copy-on-write, so a process that
+    writes into an image gets a private copy of its pages. With
+    mode 'r', the file is mapped read-only and writes fail instead,
+    which files shared with other processes rely on.
+    """
+    def __init__(self, path: str, mode: str = 'c'):
+        self.path = path
+        self.mode = mode
+
+        with open(self.index_path(path), 'r') as file:
+            index = json.load(file)
+
+        self.documents = index['documents']
+        self.image_shape = tuple(index['image_shape'])
+
+        self.images = self._open()
+
+    def _open(self) -> np.memmap:
+        return np.memmap(
+            self.path,
+            dtype=np.uint8,
+            mode=self.mode,
+            shape=(len(self.documents), *self.image_shape),
+        )
+
+    def __getstate__(self) -> dict:
+        """
+        DataLoader workers receive a pickled copy of the dataset.
+        Only the path and index are sent, and each worker maps the
+        file itself instead of receiving a copy of all images.
+        """
+        state = self.__dict__.copy()
+        del state['images']
+
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.images = self._open()
+
+    @staticmethod
+    def index_path(path: str) -> str:
+        return path + '.json'
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        """
+        The index is written after all images have been flushed,
+        so it doubles as the marker for a complete cache.
+        """
+        return os.path.exists(ImageCache.index_path(path)) \
+            and os.path.exists(path)
+
+    @staticmethod
+    def create(
+        path: str,
+        documents: list[str],
+        image_shape: tuple[int, int, int],
+    ) -> np.memmap:
+        if os.path.exists(ImageCache.index_path(path)):
+            os.remove(ImageCache.index_path(path))
+
+        return np.memmap(
+            path,
+            dtype=np.uint8,
+            mode='w+',
+            shape=(len(documents), *image_shape),
+        )
+
+    @staticmethod
+    def finalize(
+        path: str,
+        images: np.memmap,
+        documents: list[str],
+    ) -> None:
+        images.flush()
+
+        with open(ImageCache.index_path(path), 'w') as file:
+            json.dump({
+                'documents': documents,
+                'image_shape': list(images.shape[1:]),
+            }, file)
+
+    @property
+    def nbytes(self) -> int:
+        return self.images.nbytes
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def __contains__(self, index: int) -> bool:
+        return 0 <= index < len(self.documents)
+
+    def __getitem__(self, index: int) -> torch.Tensor:
+        if self.mode != 'r':
+            return torch.from_numpy(self.images[index])
+
+        # Tensors of read-only maps are read-only as well; any write
+        # into them fails
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', message='The given NumPy array is not writable')
+
+            return torch.from_numpy(self.images[index])
@@ -0,0 +1,107 @@
+import torch
+from torchvision import transforms
+
+from dataset.ImageCache import ImageCache
+
+
+class ImagePyramid:
+    """
+    A resolution-independent image cache. Every image is stored at
+    several levels, level k being 1 / 2^k of the original size, each
+    level in memory-mapped ImageCaches. Any size up to the largest
+    level is produced by resizing from the smallest level that is
+    still at least as large, so models with different input sizes
+    share one cache instead of decoding the dataset again.
+    Images may be spread over several segments, each holding one
+    ImageCache per level. rows maps every dataset index to its
+    (segment, slot), or to None if the image is not cached.
+    """
+    def __init__(
+        self,
+        segments: list[list[str]],
+        rows: list[tuple[int, int]],
+        levels: list[int],
+    ):
+        self.levels = levels
+        self.rows = rows
+        self.segments = [
+            [ImageCache(path) for path in level_paths]
+            for level_paths in segments
+        ]
+
+    @staticmethod
+    def level_sizes(
+        original_image_size: tuple[int, int],
+        levels: list[int],
+    ) -> list[tuple[int, int]]:
+        height, width = original_image_size
+
+        return [
+            (int(round(height / 2 ** level)), int(round(width / 2 ** level)))
+            for level in levels
+        ]
+
+    @property
+    def level_shapes(self) -> list[tuple[int, int]]:
+        return [cache.image_shape[-2:] for cache in self.segments[0]]
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, index: int) -> bool:
+        return self.rows[index] is not None
+
+    def level_for(self, size: tuple[int, int]) -> int:
+        """
+        The smallest level that is at least as large as size
+        in both dimensions.
+        """
+        height, width = size
+
+        candidates = [
+            level for level, shape in enumerate(self.level_shapes)
+            if shape[0] >= height and shape[1] >= width
+        ]
+
+        if len(candidates) == 0:
+            raise ValueError(
+                f'No pyramid level is large enough for {size}, '
+                f'the largest level is {self.level_shapes[0]}'
+            )
+
+        return min(candidates, key=lambda level: self.level_shapes[level][1])
+
+    def image(self, index: int, level: int) -> torch.Tensor:
+        segment, slot = self.rows[index]
+
+        return self.segments[segment][level][slot]
+
+    def resized(self, size: tuple[int, int]) -> 'ResizedImages':
+        return ResizedImages(self, self.level_for(size), size)
+
+
+class ResizedImages:
+    """
+    Images of one pyramid level, resized to size when indexed.
+    If the level already has the requested size, the memory-mapped
+    image is returned as is.
+    """
+    def __init__(self, pyramid: ImagePyramid, level: int, size: tuple[int, int]):
+        self.pyramid = pyramid
+        self.level = level
+        self.size = tuple(size)
+        self.resize = transforms.Resize(self.size)
+
+    def __len__(self) -> int:
+        return len(self.pyramid)
+
+    def __contains__(self, index: int) -> bool:
+        return index in self.pyramid
+
+    def __getitem__(self, index: int) -> torch.Tensor:
+        image = self.pyramid.image(index, self.level)
+
+        if tuple(image.shape[-2:]) == self.size:
+            return image
+
+        return self.resize(image)
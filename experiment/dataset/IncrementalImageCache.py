@@ -0,0 +1,228 @@
+import fcntl
+import hashlib
+import json
+import os
+import uuid
+from contextlib import contextmanager
+from typing import Iterator
+import numpy as np
+
+from dataset.ImageCache import ImageCache
+from dataset.ImagePyramid import ImagePyramid
+
+
+class IncrementalImageCache:
+    """
+    An append-only image pyramid cache inside one cache directory
+    entry. Every CSV row is identified by a key hashing its document
+    name, its points string and the size and modification time of
+    its image file. Rows whose key is already cached are reused;
+    new or changed rows are decoded and appended as a new segment,
+    so weekly additions to the annotation CSV only cost decoding
+    the added images.
+    The index mapping row keys to (segment, slot) is only updated
+    under a file lock and replaced atomically, so concurrent jobs
+    never see segments that are still being written.
+    Rows of earlier versions of the CSV stay in their segments until
+    compact rewrites the rows that are still used.
+    """
+    index_file = 'index.json'
+    lock_file = 'index.lock'
+
+    def __init__(self, path: str, levels: list[int]):
+        self.path = path
+        self.levels = levels
+
+        os.makedirs(path, exist_ok=True)
+
+        self.index = self._read_index()
+
+    @staticmethod
+    def row_key(document: str, points: str, image_path: str) -> str:
+        stat = os.stat(image_path)
+
+        return hashlib.sha1(
+            f'{document}\0{points}\0{stat.st_size}\0{stat.st_mtime_ns}'
+            .encode()
+        ).hexdigest()
+
+    def _read_index(self) -> dict:
+        index_path = os.path.join(self.path, self.index_file)
+
+        if not os.path.exists(index_path):
+            return {'segments': [], 'rows': {}}
+
+        with open(index_path, 'r') as file:
+            return json.load(file)
+
+    def _write_index(self, index: dict) -> None:
+        index_path = os.path.join(self.path, self.index_file)
+        temporary_path = f'{index_path}.tmp-{os.getpid()}'
+
+        with open(temporary_path, 'w') as file:
+            json.dump(index, file)
+
+        os.replace(temporary_path, index_path)
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        with open(os.path.join(self.path, self.lock_file), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _segment_paths(self, segment: str) -> list[str]:
+        return [
+            os.path.join(self.path, f'{segment}_level{level}.u8')
+            for level in self.levels
+        ]
+
+    def _segment_files(self, segment: str) -> list[str]:
+        return [
+            file_path
+            for path in self._segment_paths(segment)
+            for file_path in [path, ImageCache.index_path(path)]
+        ]
+
+    def nbytes(self, index: dict = None) -> int:
+        """
+        The size of all segment files of an index, the current one if
+        None.
+        """
+        index = index if index is not None else self.index
+
+        return sum(
+            os.path.getsize(path)
+            for segment in index['segments']
+            for path in self._segment_files(segment)
+            if os.path.exists(path)
+        )
+
+    def missing(self, row_keys: list[str]) -> list[int]:
+        """
+        Positions of the row keys that are not cached yet.
+        """
+        return [
+            position for position, key in enumerate(row_keys)
+            if key not in self.index['rows']
+        ]
+
+    def append(
+        self,
+        row_keys: list[str],
+        documents: list[str],
+        level_sizes: list[tuple[int, int]],
+        pyramids: Iterator[list[np.ndarray]],
+    ) -> None:
+        """
+        Write the decoded pyramids of the given rows into a new
+        segment and register it in the index.
+        """
+        segment = f'segment_{uuid.uuid4().hex[:12]}'
+        segment_paths = self._segment_paths(segment)
+
+        levels = [
+            ImageCache.create(path, documents, (1, *size))
+            for path, size in zip(segment_paths, level_sizes)
+        ]
+
+        for slot, pyramid in enumerate(pyramids):
+            for level, image in zip(levels, pyramid):
+                level[slot] = image
+
+        for path, level in zip(segment_paths, levels):
+            ImageCache.finalize(path, level, documents)
+
+        with self._locked():
+            index = self._read_index()
+            segment_index = len(index['segments'])
+
+            index['segments'].append(segment)
+            index['rows'].update({
+                key: [segment_index, slot]
+                for slot, key in enumerate(row_keys)
+            })
+
+            self._write_index(index)
+
+        self.index = index
+
+    def compact(self, row_keys: list[str]) -> tuple[int, int]:
+        """
+        Rewrite the cached rows among row_keys, the rows the CSV still
+        uses, into one fresh segment, and delete all other rows and
+        segments. Returns the size of the segments before and after.
+        The cache stays locked throughout, so no rows are appended in
+        the meantime; jobs that have already mapped the old segments
+        keep reading them, as deleted files stay mapped.
+        """
+        with self._locked():
+            index = self._read_index()
+            before = self.nbytes(index)
+
+            row_keys = [
+                key for key in dict.fromkeys(row_keys)
+                if key in index['rows']
+            ]
+            compacted = {'segments': [], 'rows': {}}
+
+            if len(row_keys) > 0:
+                pyramid = ImagePyramid(
+                    [self._segment_paths(segment) for segment in index['segments']],
+                    [tuple(index['rows'][key]) for key in row_keys],
+                    self.levels,
+                )
+                documents = [
+                    pyramid.segments[segment][0].documents[slot]
+                    for segment, slot in pyramid.rows
+                ]
+
+                segment = f'segment_{uuid.uuid4().hex[:12]}'
+                segment_paths = self._segment_paths(segment)
+
+                for level, path in enumerate(segment_paths):
+                    images = ImageCache.create(
+                        path,
+                        documents,
+                        pyramid.segments[0][level].image_shape,
+                    )
+
+                    for slot in range(len(row_keys)):
+                        images[slot] = pyramid.image(slot, level).numpy()
+
+                    ImageCache.finalize(path, images, documents)
+
+                compacted = {
+                    'segments': [segment],
+                    'rows': {key: [0, slot] for slot, key in enumerate(row_keys)},
+                }
+
+            self._write_index(compacted)
+
+            for old_segment in index['segments']:
+                for path in self._segment_files(old_segment):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+        self.index = compacted
+
+        return before, self.nbytes(compacted)
+
+    def pyramid(self, row_keys: list[str]) -> ImagePyramid:
+        """
+        An ImagePyramid over the given rows. Rows that are not cached
+        map to None.
+        """
+        rows = [
+            tuple(self.index['rows'][key]) if key in self.index['rows'] else None
+            for key in row_keys
+        ]
+
+        return ImagePyramid(
+            [self._segment_paths(segment) for segment in self.index['segments']],
+            rows,
+            self.levels,
+        )
@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import torch
+from torch.utils.data import get_worker_info
+
+
+class LRUImageCache:
+    """
+    Keeps decoded images in memory up to a budget of max_bytes.
+    When the budget is exceeded, the least recently used images are
+    evicted first. Hits and misses are counted so that the cache
+    size can be tuned to the access pattern.
+    Every DataLoader worker holds its own copy of the cache, so
+    max_bytes is split evenly between the workers of a DataLoader
+    and bounds the memory of all of them together. The counters live
+    in a small shared memory tensor with a row per process, so stats
+    sums them over the main process and all workers.
+    """
+    max_processes = 64
+    hits_column, misses_column, bytes_column, images_column = range(4)
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.images = OrderedDict()
+        self.counters = torch.zeros(self.max_processes, 4, dtype=torch.long).share_memory_()
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    def __contains__(self, key: int) -> bool:
+        return key in self.images
+
+    @staticmethod
+    def _process() -> tuple[int, int]:
+        """
+        The counter row of this process, 0 for the main process and
+        1 + the worker id for DataLoader workers, and the number of
+        processes the budget is split between.
+        """
+        worker_info = get_worker_info()
+
+        if worker_info is None:
+            return 0, 1
+
+        return 1 + worker_info.id % (LRUImageCache.max_processes - 1), worker_info.num_workers
+
+    @property
+    def budget(self) -> int:
+        """
+        The bytes this process may keep.
+        """
+        return self.max_bytes // self._process()[1]
+
+    @property
+    def hits(self) -> int:
+        return self.counters[:, self.hits_column].sum().item()
+
+    @property
+    def misses(self) -> int:
+        return self.counters[:, self.misses_column].sum().item()
+
+    @property
+    def hit_rate(self) -> float:
+        hits, misses = self.hits, self.misses
+        total = hits + misses
+
+        return hits / total if total > 0 else 0.0
+
+    def stats(self) -> dict[str, float]:
+        """
+        The counters of the main process and all workers together.
+        """
+        return {
+            'image_cache_hits': self.hits,
+            'image_cache_misses': self.misses,
+            'image_cache_hit_rate': self.hit_rate,
+            'image_cache_bytes': self.counters[:, self.bytes_column].sum().item(),
+            'image_cache_images': self.counters[:, self.images_column].sum().item(),
+        }
+
+    def _count(self, column: int) -> None:
+        self.counters[self._process()[0], column] += 1
+
+    def _record_size(self) -> None:
+        row = self._process()[0]
+
+        self.counters[row, self.bytes_column] = self.nbytes
+        self.counters[row, self.images_column] = len(self)
+
+    def get(self, key: int) -> torch.Tensor:
+        if key not in self.images:
+            self._count(self.misses_column)
+            return None
+
+        self._count(self.hits_column)
+        self.images.move_to_end(key)
+
+        return self.images[key]
+
+    def put(self, key: int, image: torch.Tensor) -> None:
+        image_bytes = self._nbytes(image)
+        budget = self.budget
+
+        if image_bytes > budget:
+            return
+
+        if key in self.images:
+            self.nbytes -= self._nbytes(self.images.pop(key))
+
+        self.images[key] = image
+        self.nbytes += image_bytes
+
+        while self.nbytes > budget:
+            _, evicted = self.images.popitem(last=False)
+            self.nbytes -= self._nbytes(evicted)
+
+        self._record_size()
+
+    def clear(self) -> None:
+        self.images.clear()
+        self.nbytes = 0
+        self._record_size()
+
+    @staticmethod
+    def _nbytes(image: torch.Tensor) -> int:
+        return image.element_size() * image.nelement()
@@ -0,0 +1,93 @@
+import torch
+from torch.utils.data import Dataset
+from torchvision import transforms
+
+from dataset.LateralSkullRadiographDataset import LateralSkullRadiographDataset
+
+
+class LandmarkCropDataset(Dataset):
+    """
+    Training samples as crops of crop_size, cut from pyramid level
+    level of the images around a randomly chosen annotated landmark,
+    instead of whole images shrunk to the model's input size. Each
+    step then costs the same whatever the resolution of the source.
+    The points of dataset are given at its resized_image_size; a crop
+    covers crop_size pixels at that size, cut from the level image
+    and resized if the level is not exactly that size. The crop
+    center is the landmark shifted by up to jitter / 2 of the crop
+    size in both directions, and crops are kept inside the image.
+    Points are moved into the crop, and points outside of it are set
+    to -1 so that they are masked like missing points.
+    """
+    def __init__(
+        self,
+        dataset: LateralSkullRadiographDataset,
+        indices: list[int],
+        crop_size: tuple[int, int],
+        level: int,
+        jitter: float = 0.75,
+    ):
+        self.dataset = dataset
+        self.indices = indices
+        self.crop_size = tuple(crop_size)
+        self.level = level
+        self.jitter = jitter
+        self.resize = transforms.Resize(self.crop_size)
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def _center(
+        self,
+        points: torch.Tensor,
+        window: torch.Tensor,
+        image_size: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        The (x, y) crop center in level pixels.
+        """
+        valid = (points > 0).all(-1).nonzero().flatten()
+
+        if len(valid) == 0:
+            return torch.rand(2) * image_size
+
+        landmark = points[valid[torch.randint(len(valid), ())]]
+
+        return landmark + self.jitter * (torch.rand(2) - 0.5) * window
+
+    def __getitem__(self, index: int) -> tuple[torch.Tensor, torch.Tensor]:
+        idx = self.indices[index]
+
+        image = self.dataset.level_image(idx, self.level)
+        height, width = image.shape[-2:]
+
+        image_size = torch.tensor([width, height], dtype=torch.float32)
+        scale = image_size / torch.tensor(self.dataset.resized_image_size[::-1])
+        crop_size = torch.tensor(self.crop_size[::-1], dtype=torch.float32)
+
+        window = torch.minimum((crop_size * scale).round(), image_size)
+        points = torch.where(
+            self.dataset.points[idx] > 0,
+            self.dataset.points[idx] * scale,
+            self.dataset.points[idx],
+        )
+
+        left, top = (self._center(points, window, image_size) - window / 2) \
+            .round().clamp(min=0).minimum(image_size - window).long().tolist()
+        window_width, window_height = window.long().tolist()
+
+        crop = image[..., top:top + window_height, left:left + window_width]
+
+        if tuple(crop.shape[-2:]) != self.crop_size:
+            crop = self.resize(crop)
+
+        crop_points = (points - torch.tensor([left, top])) * crop_size / window
+
+        inside = (points > 0).all(-1) & (crop_points > 0).all(-1) \
+            & (crop_points < crop_size).all(-1)
+        crop_points[~inside] = -1
+
+        if self.dataset.transform is not None:
+            crop = self.dataset.transform(self.dataset.to_float(crop))
+
+        return crop, crop_points
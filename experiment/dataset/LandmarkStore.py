@@ -0,0 +1,199 @@
+import ast
+import hashlib
+import os
+import re
+import numpy as np
+import pandas as pd
+import torch
+
+
+class LandmarkStore:
+    """
+    Columnar landmark annotations of a dataset:
+    - documents: the document of every row
+    - point_ids: the ids of the K landmarks
+    - points: float32 array of shape (N, K, 2) with (x, y) in
+      original image coordinates
+    - valid: bool array of shape (N, K), False for points that are
+      missing or lie outside of the original image
+    - csv_hash: the file_hash of the CSV the points were read from
+      or written to, or '' if unknown
+    The points column of the CSV holds one dict string per row,
+    e.g. "{0: {'x': 832.0, 'y': 994.0}, ...}". All rows are parsed
+    with one regular expression pass instead of a literal_eval per
+    row, and the result is saved as an .npz file that loads in
+    milliseconds.
+    """
+    coordinates_pattern = re.compile(
+        r"'x':\s*([^,}\s]+)\s*,\s*'y':\s*([^,}\s]+)"
+    )
+
+    def __init__(
+        self,
+        documents: np.ndarray,
+        point_ids: list[str],
+        points: np.ndarray,
+        valid: np.ndarray,
+        csv_hash: str = '',
+    ):
+        self.documents = documents
+        self.point_ids = point_ids
+        self.points = points
+        self.valid = valid
+        self.csv_hash = csv_hash
+
+    @staticmethod
+    def parse_points(point_strings: pd.Series) -> tuple[list[str], np.ndarray]:
+        """
+        The point ids and the (N, K, 2) points of a column of dict
+        strings. Only the first row is parsed as a literal to read
+        the ids. Every row has to hold as many points as the first.
+        """
+        point_ids = [
+            str(key) for key in ast.literal_eval(point_strings.iloc[0])
+        ]
+
+        num_rows, num_points = len(point_strings), len(point_ids)
+        counts = point_strings.str.count(LandmarkStore.coordinates_pattern).to_numpy()
+        wrong_rows = np.flatnonzero(counts != num_points)
+
+        if len(wrong_rows) > 0:
+            row = wrong_rows[0]
+
+            raise ValueError(
+                f'Expected {num_points} points in each of the {num_rows} '
+                f'rows, but parsed {counts[row]} points in row {row}; '
+                f'{len(wrong_rows)} rows have a wrong number of points'
+            )
+
+        coordinates = np.array(
+            LandmarkStore.coordinates_pattern.findall('\n'.join(point_strings)),
+            dtype=np.float32,
+        )
+
+        return point_ids, coordinates.reshape(num_rows, num_points, 2)
+
+    @staticmethod
+    def format_points(point_ids: list[str], points: np.ndarray) -> list[str]:
+        """
+        The dict strings of the points column, the inverse of
+        parse_points. Numeric ids are written as integers.
+        """
+        keys = [
+            point_id if point_id.isdigit() else repr(point_id)
+            for point_id in point_ids
+        ]
+
+        return [
+            '{' + ', '.join(
+                f"{key}: {{'x': {x}, 'y': {y}}}"
+                for key, (x, y) in zip(keys, row)
+            ) + '}'
+            for row in points.tolist()
+        ]
+
+    @staticmethod
+    def from_points(
+        documents: np.ndarray,
+        point_ids: list[str],
+        points: np.ndarray,
+        original_image_size: tuple[int, int],
+        csv_hash: str = '',
+    ) -> 'LandmarkStore':
+        points = points.astype(np.float32)
+
+        return LandmarkStore(
+            documents=np.asarray(documents, dtype=str),
+            point_ids=point_ids,
+            points=points,
+            valid=LandmarkStore._valid(points, original_image_size),
+            csv_hash=csv_hash,
+        )
+
+    @staticmethod
+    def from_data_frame(
+        data_frame: pd.DataFrame,
+        original_image_size: tuple[int, int],
+        csv_hash: str = '',
+    ) -> 'LandmarkStore':
+        point_ids, points = LandmarkStore.parse_points(data_frame['points'])
+
+        return LandmarkStore.from_points(
+            data_frame['document'].to_numpy(dtype=str),
+            point_ids,
+            points,
+            original_image_size,
+            csv_hash,
+        )
+
+    @staticmethod
+    def _valid(
+        points: np.ndarray,
+        original_image_size: tuple[int, int],
+    ) -> np.ndarray:
+        height, width = original_image_size
+
+        return (points > 0).all(-1) \
+            & (points[..., 0] <= width) \
+            & (points[..., 1] <= height)
+
+    @staticmethod
+    def csv_landmarks_file(csv_file: str) -> str:
+        """
+        The name of the landmark file ingest_annotations.py writes
+        next to a CSV.
+        """
+        return f'{os.path.splitext(csv_file)[0]}_landmarks.npz'
+
+    @staticmethod
+    def file_hash(path: str) -> str:
+        """
+        A hash of the bytes of a file, to tell versions of a CSV apart.
+        """
+        with open(path, 'rb') as file:
+            return hashlib.sha1(file.read()).hexdigest()[:16]
+
+    @staticmethod
+    def load(path: str) -> 'LandmarkStore':
+        with np.load(path) as data:
+            return LandmarkStore(
+                documents=data['documents'],
+                point_ids=data['point_ids'].tolist(),
+                points=data['points'],
+                valid=data['valid'],
+                csv_hash=str(data['csv_hash']) if 'csv_hash' in data else '',
+            )
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as file:
+            np.savez(
+                file,
+                documents=self.documents,
+                point_ids=np.array(self.point_ids, dtype=str),
+                points=self.points,
+                valid=self.valid,
+                csv_hash=np.array(self.csv_hash),
+            )
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    @property
+    def num_points(self) -> int:
+        return len(self.point_ids)
+
+    def resized(
+        self,
+        original_image_size: tuple[int, int],
+        resized_image_size: tuple[int, int],
+    ) -> torch.Tensor:
+        """
+        All points rescaled to resized_image_size at once.
+        Invalid points are set to (-1, -1).
+        """
+        scale = np.array(resized_image_size[::-1], dtype=np.float32) \
+            / np.array(original_image_size[::-1], dtype=np.float32)
+
+        resized = np.where(self.valid[..., None], self.points * scale, -1)
+
+        return torch.from_numpy(resized.astype(np.float32))
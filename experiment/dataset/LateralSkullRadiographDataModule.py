@@ -1,11 +1,30 @@
+import json
+import os
 import lightning as L
-from torch.utils.data import random_split, DataLoader
+import numpy as np
+import torch
+from torch.utils.data import random_split, DataLoader, Subset
 from typing import Callable
 
 from dataset.LateralSkullRadiographDataset import LateralSkullRadiographDataset
+from dataset.LandmarkCropDataset import LandmarkCropDataset
+from dataset.ImagePyramid import ImagePyramid
+from dataset.ShardedRadiographDataset import ShardedRadiographDataset
+from dataset.DeviceResidentDataset import DeviceResidentDataset, IndexBatchSampler
+from dataset.BatchAugmentation import BatchAugmentation
+from dataset.LossAwareSampler import LossAwareSampler
 
 
 class LateralSkullRadiographDataModule(L.LightningDataModule):
+    split_names = ['train', 'val', 'test']
+
+    stage_splits = {
+        'fit': ['train', 'val'],
+        'validate': ['val'],
+        'test': ['test'],
+        'predict': ['test'],
+    }
+
     def __init__(
         self,
         root_dir: str,
@@ -13,25 +32,132 @@ class LateralSkullRadiographDataModule(L.LightningDataModule):
         resized_image_size: tuple[int, int],
         transform: Callable = None,
         splits: tuple[int, int, int] = (0.8, 0.1, 0.1),
+        split_file: str = None,
         batch_size: int = 32,
         flip_augmentations: bool = True,
+        color_augmentations: bool = False,
+        seed: int = 0,
+        decode_workers: int = None,
+        draft_decoding: bool = False,
+        lazy_loading: bool = False,
+        image_cache_bytes: int = 2 * 1024 ** 3,
+        pyramid_levels: tuple[int, ...] = (1, 2, 3),
+        cache_dir: str = None,
+        cache_max_bytes: int = None,
+        shared_memory: bool = False,
+        num_workers: int = 0,
+        prefetch_factor: int = 2,
+        persistent_workers: bool = False,
+        train_shards: str = None,
+        shuffle_buffer: int = 256,
+        device_resident: bool = False,
+        hard_example_sampling: bool = False,
+        uniform_fraction: float = 0.5,
+        samples_per_epoch: int = None,
+        crop_level: int = None,
+        crop_jitter: float = 0.75,
     ):
+        """
+        With crop_level, training uses crops of resized_image_size cut
+        around landmarks from pyramid level crop_level, see
+        LandmarkCropDataset, and validation and testing use whole
+        images at the size of that level, rounded down to a multiple
+        of 32. The size of the training crops is crop_size, and the
+        size whole images are loaded, evaluated and measured at is
+        eval_image_size; without crop_level, both are
+        resized_image_size.
+        """
         super().__init__()
 
+        if hard_example_sampling and (train_shards is not None or device_resident):
+            raise ValueError(
+                'Hard example sampling draws training rows by index and '
+                'works with neither train_shards nor device_resident'
+            )
+
+        self.crop_level = crop_level
+        self.crop_jitter = crop_jitter
+        self.resized_image_size = tuple(resized_image_size)
+        self.crop_size = None
+        self.eval_image_size = self.resized_image_size
+
+        if crop_level is not None:
+            if train_shards is not None or device_resident:
+                raise ValueError(
+                    'Crops are cut from the image cache on every step and '
+                    'work with neither train_shards nor device_resident'
+                )
+
+            self.crop_size = self.resized_image_size
+            self.eval_image_size = self.crop_level_image_size(
+                root_dir,
+                crop_level,
+                pyramid_levels,
+            )
+
+            print(
+                f'Training on {self.crop_size} crops of pyramid level '
+                f'{crop_level}, evaluating whole images at {self.eval_image_size}'
+            )
+
         self.dataset = LateralSkullRadiographDataset(
             root_dir=root_dir,
             csv_file=csv_file,
             transform=transform,
-            resized_image_size=resized_image_size,
-            flip_augmentations=flip_augmentations,
+            resized_image_size=self.eval_image_size,
+            decode_workers=decode_workers,
+            draft_decoding=draft_decoding,
+            lazy=lazy_loading,
+            image_cache_bytes=image_cache_bytes,
+            pyramid_levels=pyramid_levels,
+            cache_dir=cache_dir,
+            cache_max_bytes=cache_max_bytes,
+            shared_memory=shared_memory,
+            rows=[],
         )
 
-        self.train_dataset, self.val_dataset, self.test_dataset = random_split(
-            self.dataset,
-            self._get_splits(splits)
+        self.flip_augmentations = bool(flip_augmentations)
+        self.color_augmentations = bool(color_augmentations)
+        self.batch_size = batch_size
+        self.hard_example_sampling = hard_example_sampling
+        self.uniform_fraction = uniform_fraction
+        self.samples_per_epoch = samples_per_epoch
+        self.set_splits(self.random_splits(splits, split_file), seed)
+
+        self.train_shards = ShardedRadiographDataset(
+            train_shards,
+            resized_image_size=resized_image_size,
+            buffer_size=shuffle_buffer,
+            seed=seed,
+            draft_decoding=draft_decoding,
+        ) if train_shards is not None else None
+
+        self.device_resident = device_resident
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.persistent_workers = persistent_workers
+
+    @staticmethod
+    def crop_level_image_size(
+        root_dir: str,
+        crop_level: int,
+        pyramid_levels: tuple[int, ...],
+        multiple: int = 32,
+    ) -> tuple[int, int]:
+        if crop_level not in pyramid_levels:
+            raise ValueError(
+                f'Crop level {crop_level} is not one of the pyramid levels '
+                f'{list(pyramid_levels)}, so its images would be decoded '
+                'on every step; add it to the pyramid levels'
+            )
+
+        metadata = LateralSkullRadiographDataset.read_metadata(root_dir)
+        level_size, = ImagePyramid.level_sizes(
+            (metadata['image_height'], metadata['image_width']),
+            [crop_level],
         )
 
-        self.batch_size = batch_size
+        return tuple(size // multiple * multiple for size in level_size)
 
     def _get_splits(
         self,
@@ -45,21 +171,353 @@ class LateralSkullRadiographDataModule(L.LightningDataModule):
 
         return train_size, val_size, test_size
 
+    def _read_split_file(
+        self,
+        split_file: str,
+        sizes: list[int],
+    ) -> dict[str, list[int]]:
+        """
+        The splits saved in split_file, or None if there are none or
+        they were written for another number of rows or split sizes.
+        """
+        if split_file is None or not os.path.exists(split_file):
+            return None
+
+        with open(split_file, 'r') as file:
+            saved = json.load(file)
+
+        if saved['num_rows'] != len(self.dataset) or saved['sizes'] != list(sizes):
+            print(f'{split_file} does not match the dataset, splitting again...')
+            return None
+
+        return {name: saved[name] for name in self.split_names}
+
+    def _write_split_file(
+        self,
+        split_file: str,
+        rows: dict[str, list[int]],
+    ) -> None:
+        if split_file is None:
+            return
+
+        os.makedirs(os.path.dirname(split_file) or '.', exist_ok=True)
+
+        with open(split_file, 'w') as file:
+            json.dump({
+                'num_rows': len(self.dataset),
+                'sizes': [len(rows[name]) for name in self.split_names],
+                **rows,
+            }, file)
+
+    def random_splits(
+        self,
+        splits: tuple[int, int, int],
+        split_file: str = None,
+    ) -> dict[str, list[int]]:
+        """
+        The rows of every split, computed from the number of rows
+        alone, before any image is loaded. The permutation is the same
+        random_split drew over the dataset before. With split_file,
+        the splits are read from it if it was written for the same
+        number of rows and split sizes, and written to it otherwise.
+        """
+        sizes = self._get_splits(splits)
+        rows = self._read_split_file(split_file, sizes)
+
+        if rows is None:
+            rows = {
+                name: list(subset.indices)
+                for name, subset in zip(
+                    self.split_names,
+                    random_split(range(len(self.dataset)), sizes),
+                )
+            }
+
+            self._write_split_file(split_file, rows)
+
+        return rows
+
+    def kfold_splits(
+        self,
+        folds: int,
+        fold: int,
+        splits: tuple[int, int, int],
+        seed: int,
+        split_file: str = None,
+    ) -> dict[str, list[int]]:
+        """
+        The rows of one fold of a k-fold cross-validation. The rows
+        are shuffled once per seed and cut into folds equal parts;
+        fold is the test split and the other rows are divided into
+        training and validation rows in the ratio of splits[:2].
+        split_file is used as in random_splits.
+        """
+        parts = np.array_split(
+            np.random.default_rng(seed).permutation(len(self.dataset)),
+            folds,
+        )
+        test_rows = parts[fold]
+        other_rows = np.concatenate(parts[:fold] + parts[fold + 1:])
+
+        val_size = int(len(other_rows) * splits[1] / (splits[0] + splits[1]))
+        sizes = [len(other_rows) - val_size, val_size, len(test_rows)]
+
+        saved_rows = self._read_split_file(split_file, sizes)
+
+        if saved_rows is not None:
+            return saved_rows
+
+        fold_rows = {
+            'train': other_rows[val_size:].tolist(),
+            'val': other_rows[:val_size].tolist(),
+            'test': test_rows.tolist(),
+        }
+
+        self._write_split_file(split_file, fold_rows)
+
+        return fold_rows
+
+    def set_splits(self, rows: dict[str, list[int]], seed: int) -> None:
+        """
+        Switch to other splits of the same dataset, e.g. for the next
+        run or fold, and reseed the augmentations. Images that are
+        already loaded are reused, so only rows that no earlier split
+        needed are loaded on the next setup.
+        """
+        self.splits = rows
+        self.train_dataset, self.val_dataset, self.test_dataset = [
+            Subset(self.dataset, rows[name]) for name in self.split_names
+        ]
+
+        if self.crop_level is not None:
+            self.train_dataset = LandmarkCropDataset(
+                self.dataset,
+                rows['train'],
+                self.crop_size,
+                self.crop_level,
+                jitter=self.crop_jitter,
+            )
+
+        self.seed = seed
+        self.augmentation = BatchAugmentation(
+            flip=self.flip_augmentations,
+            color=self.color_augmentations,
+            seed=seed,
+        )
+
+        self.sampler = LossAwareSampler(
+            len(self.train_dataset),
+            self.batch_size,
+            uniform_fraction=self.uniform_fraction,
+            samples_per_epoch=self.samples_per_epoch,
+            seed=seed,
+        ) if self.hard_example_sampling else None
+
+    def check_train_shards(self) -> None:
+        """
+        Training on shards that hold validation or test rows would
+        leak them into training, so the rows of the shards must not
+        overlap with the val and test splits.
+        """
+        if self.train_shards.rows is None:
+            raise ValueError(
+                f'{self.train_shards.shard_dir} does not list its rows, '
+                'write it again with write_shards.py --split_file'
+            )
+
+        leaked = set(self.train_shards.rows) \
+            & set(self.splits['val'] + self.splits['test'])
+
+        if len(leaked) > 0:
+            raise ValueError(
+                f'{self.train_shards.shard_dir} holds {len(leaked)} validation '
+                'or test rows, write it with the split file of this run'
+            )
+
+    def load_stage(self, stage: str) -> None:
+        """
+        Load the images of the splits a stage uses, and only those.
+        """
+        names = self.stage_splits[stage]
+
+        if self.train_shards is not None:
+            self.check_train_shards()
+            names = [name for name in names if name != 'train']
+
+        self.dataset.load_rows([
+            row for name in names for row in self.splits[name]
+        ])
+
+    def setup(self, stage: str) -> None:
+        """
+        Only the images of the splits the stage uses are loaded. In
+        device resident mode, these splits are stacked onto the device
+        of the trainer once, before the first batch is drawn.
+        """
+        self.load_stage(stage)
+
+        if self.device_resident:
+            self.to_device(
+                self.trainer.strategy.root_device
+                if self.trainer is not None else torch.device('cpu'),
+                stage,
+            )
+
+    def to_device(self, device: torch.device, stage: str) -> None:
+        for name in self.stage_splits[stage]:
+            dataset = getattr(self, f'{name}_dataset')
+
+            if isinstance(dataset, DeviceResidentDataset):
+                continue
+
+            print(f'Moving {name} split to {device}...')
+            setattr(
+                self,
+                f'{name}_dataset',
+                DeviceResidentDataset.from_dataset(dataset, device),
+            )
+
+    def _device_resident_dataloader(
+        self,
+        dataset: DeviceResidentDataset,
+        shuffle: bool,
+    ) -> DataLoader:
+        """
+        Batches are gathered on the device by index, in the main
+        process and without collating.
+        """
+        return DataLoader(
+            dataset,
+            batch_sampler=IndexBatchSampler(
+                len(dataset),
+                self.batch_size,
+                shuffle=shuffle,
+                seed=self.seed,
+                device=dataset.images.device,
+            ),
+            collate_fn=DeviceResidentDataset.collate,
+        )
+
+    def _dataloader_args(self) -> dict:
+        """
+        Samples are decoded and stacked on the CPU in worker processes
+        and collated into pinned memory, so that the copy to the GPU
+        can happen once per batch and asynchronously.
+        """
+        args = {
+            'batch_size': self.batch_size,
+            'num_workers': self.num_workers,
+            'pin_memory': torch.cuda.is_available(),
+        }
+
+        if self.num_workers > 0:
+            args['prefetch_factor'] = self.prefetch_factor
+            args['persistent_workers'] = bool(self.persistent_workers)
+
+        return args
+
     def train_dataloader(self) -> DataLoader:
+        """
+        With train_shards, training samples are streamed from the
+        shards, which hold the training rows only, see
+        check_train_shards, while validation and testing use the
+        splits of csv_file as usual. ShardEpochCallback advances the
+        shard order every epoch.
+        """
+        if self.train_shards is not None:
+            return DataLoader(
+                self.train_shards,
+                **self._dataloader_args(),
+            )
+
+        if self.device_resident:
+            return self._device_resident_dataloader(self.train_dataset, True)
+
+        if self.sampler is not None:
+            return DataLoader(
+                self.train_dataset,
+                sampler=self.sampler,
+                **self._dataloader_args(),
+            )
+
         return DataLoader(
             self.train_dataset,
-            batch_size=self.batch_size,
             shuffle=True,
+            **self._dataloader_args(),
         )
 
     def val_dataloader(self) -> DataLoader:
+        if self.device_resident:
+            return self._device_resident_dataloader(self.val_dataset, False)
+
         return DataLoader(
             self.val_dataset,
-            batch_size=self.batch_size,
+            **self._dataloader_args(),
         )
 
     def test_dataloader(self) -> DataLoader:
+        if self.device_resident:
+            return self._device_resident_dataloader(self.test_dataset, False)
+
         return DataLoader(
             self.test_dataset,
-            batch_size=self.batch_size,
+            **self._dataloader_args(),
+        )
+
+    def image_cache_stats(self) -> dict[str, float]:
+        return self.dataset.image_cache_stats()
+
+    def prepare_batch(
+        self,
+        batch: tuple[torch.Tensor, ...],
+        augment: bool,
+    ) -> tuple[torch.Tensor, ...]:
+        """
+        Batches travel to the device as uint8 and are converted to
+        float and, if augment, augmented only once they arrive. Images
+        keep their single grayscale channel; the backbones broadcast it
+        themselves. Any elements after the points, like the image sizes
+        in mm of a CompositeDataModule, are passed through unchanged.
+        """
+        images, points, *rest = batch
+
+        images = self.dataset.to_float(images)
+
+        if augment:
+            images, points = self.augmentation(images, points)
+
+        return images, points, *rest
+
+    def on_after_batch_transfer(
+        self,
+        batch: tuple[torch.Tensor, ...],
+        dataloader_idx: int,
+    ) -> tuple[torch.Tensor, ...]:
+        """
+        Only training batches are augmented; validation and test
+        batches are evaluated as they are.
+        """
+        return self.prepare_batch(
+            batch,
+            augment=self.trainer is not None and self.trainer.training,
         )
+
+    def preview_batch(
+        self,
+        num_samples: int,
+        device: torch.device,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        The first num_samples validation samples, prepared the same way
+        as a validation batch. This avoids starting dataloader
+        workers just to plot a few predictions.
+        """
+        samples = [
+            self.val_dataset[index]
+            for index in range(min(num_samples, len(self.val_dataset)))
+        ]
+
+        batch = torch.utils.data.default_collate(samples)
+        batch = self.transfer_batch_to_device(batch, device, 0)
+
+        return self.prepare_batch(batch, augment=False)
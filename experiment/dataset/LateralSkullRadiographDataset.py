@@ -4,11 +4,23 @@ import pandas as pd
 import torch
 from torch.utils.data import Dataset
 from torchvision import transforms
-from PIL import Image
-import ast
+import hashlib
+from functools import partial
 from tqdm import tqdm
-from albumentations.augmentations.transforms import \
-        GaussNoise
+
+from dataset.CacheDirectory import CacheDirectory
+from dataset.IncrementalImageCache import IncrementalImageCache
+from dataset.LandmarkStore import LandmarkStore
+from dataset.ImagePyramid import ImagePyramid, ResizedImages
+from dataset.LRUImageCache import LRUImageCache
+from dataset.ImageCache import ImageCache
+from dataset.SharedImageStore import SharedImageStore
+from dataset.decode_image import (
+    find_image_path,
+    decode_image,
+    decode_images,
+    decode_pyramid,
+)
 
 
 class LateralSkullRadiographDataset(Dataset):
@@ -17,16 +29,21 @@ class LateralSkullRadiographDataset(Dataset):
         root_dir: str,
         csv_file: str,
         resized_image_size: tuple[int, int],
-        transform: transforms.Compose = transforms.Compose([
-            transforms.ColorJitter(
-                brightness=0.5,
-                contrast=0.5,
-                saturation=0.5
-            ),
-            GaussNoise(var_limit=0.2, mean=0, p=0.5),
-        ]),
-        flip_augmentations: bool = True,
+        transform: transforms.Compose = None,
+        decode_workers: int = None,
+        draft_decoding: bool = False,
+        lazy: bool = False,
+        image_cache_bytes: int = 2 * 1024 ** 3,
+        pyramid_levels: tuple[int, ...] = (1, 2, 3),
+        cache_dir: str = None,
+        cache_max_bytes: int = None,
+        shared_memory: bool = False,
+        rows: list[int] = None,
     ):
+        """
+        rows are the rows whose images are loaded up front, all rows
+        if None. More rows can be loaded later with load_rows.
+        """
         self.root_dir = root_dir
         self._get_metadata()
         self.data_frame = pd.read_csv(
@@ -37,47 +54,61 @@ class LateralSkullRadiographDataset(Dataset):
             }
         )
         self.csv_file = csv_file
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-        self.resize = transforms.Resize(resized_image_size)
-        self.to_tensor = transforms.ToTensor()
         self.transform = transform
-        self.flip_augmentations = flip_augmentations
+        self.decode_workers = decode_workers
+        self.draft_decoding = draft_decoding
+        self.lazy = lazy
+        self.shared_memory = shared_memory
+        self.image_cache = LRUImageCache(image_cache_bytes) if lazy else None
+        self.pyramid_levels = sorted(pyramid_levels)
+        self.cache = CacheDirectory(cache_dir, cache_max_bytes)
+
+        if shared_memory and lazy:
+            raise ValueError('Shared memory requires all images to be decoded up front')
 
         self.resized_image_size = resized_image_size
 
-        print('Loading dataset into memory...')
-        (
-            self.images,
-            self.points,
-            self.point_ids,
-        ) = self._load_data()
+        self.key, self.image_store = self._open_cache()
+        self.points, self.point_ids = self._load_points()
+        self.row_keys = [None] * len(self.data_frame)
+        self.pyramid = None
+        self.images = None
 
-        print('Done!')
+        self.load_rows(range(len(self.data_frame)) if rows is None else rows)
 
     @property
     def num_points(self) -> int:
         return len(self.point_ids)
 
-    def _get_metadata(self) -> dict:
+    @staticmethod
+    def read_metadata(root_dir: str) -> dict:
         metadata_file = os.path.join(
-            self.root_dir,
+            root_dir,
             'metadata.yaml'
         )
 
-        if os.path.exists(metadata_file):
-            with open(metadata_file, 'r') as file:
-                metadata = yaml.safe_load(file)
+        if not os.path.exists(metadata_file):
+            return None
 
-                self.original_image_size = (
-                    metadata['image_height'],
-                    metadata['image_width'],
-                )
+        with open(metadata_file, 'r') as file:
+            return yaml.safe_load(file)
 
-                self.original_image_size_mm = (
-                    metadata['image_height_mm'],
-                    metadata['image_width_mm'],
-                )
+    def _get_metadata(self) -> dict:
+        metadata = self.read_metadata(self.root_dir)
+
+        if metadata is not None:
+            self.original_image_size = (
+                metadata['image_height'],
+                metadata['image_width'],
+            )
+
+            self.original_image_size_mm = (
+                metadata['image_height_mm'],
+                metadata['image_width_mm'],
+            )
+
+        return metadata
 
     def _parse_dimensions(self, x: str) -> tuple[int, int]:
         try:
@@ -85,211 +116,279 @@ class LateralSkullRadiographDataset(Dataset):
         except Exception:
             return None
 
-    def _load_image(self, index: int, resize=True) -> torch.Tensor:
-        img_name = os.path.join(
+    def _image_path(self, index: int) -> str:
+        return find_image_path(
             self.root_dir,
-            f"images/{self.data_frame.iloc[index]['document']}"
+            self.data_frame.iloc[index]['document'],
         )
 
-        if not os.path.exists(img_name):
-            if os.path.exists(img_name + '.jpg'):
-                img_name += '.jpg'
-
-            if os.path.exists(img_name + '.png'):
-                img_name += '.png'
+    def _load_image(self, index: int, resize=True) -> torch.Tensor:
+        return torch.from_numpy(decode_image(
+            self._image_path(index),
+            self.resized_image_size if resize else None,
+            draft=self.draft_decoding,
+        ))
 
-        image = Image.open(img_name).convert('RGB')
+    @property
+    def _cache_params(self) -> dict:
+        """
+        The preprocessing parameters the cached images depend on.
+        resized_image_size is not part of them, since all sizes are
+        produced from the same pyramid.
+        """
+        return {
+            'pyramid_levels': self.pyramid_levels,
+            'draft_decoding': bool(self.draft_decoding),
+            'original_image_size': list(self.original_image_size),
+        }
+
+    def _open_cache(self) -> tuple[str, IncrementalImageCache]:
+        key = CacheDirectory.key(self.root_dir, self.csv_file, self._cache_params)
+        entry_path = self.cache.entry(key, {
+            'root_dir': os.path.abspath(self.root_dir),
+            'csv_file': self.csv_file,
+            **self._cache_params,
+        })
+
+        return key, IncrementalImageCache(entry_path, self.pyramid_levels)
+
+    def _row_key(self, row: int, image_path: str) -> str:
+        return IncrementalImageCache.row_key(
+            self.data_frame.iloc[row]['document'],
+            self.data_frame.iloc[row]['points'],
+            image_path,
+        )
 
-        image = self.to_tensor(image)
+    def _saved_landmarks_path(self, directory: str, csv_hash: str) -> str:
+        return os.path.join(directory, f'landmarks_{csv_hash}.npz')
 
-        if resize:
-            image = self.resize(image)
+    def _load_dataset(
+        self,
+        cache: IncrementalImageCache,
+        image_paths: dict[int, str],
+        row_keys: list[str],
+        rows: list[int],
+    ) -> None:
+        """
+        Decode the images of the given rows once in a process pool and
+        append all their pyramid levels to the cache, writing straight
+        into memory-mapped files so they never have to be held in
+        memory at the same time.
+        """
+        level_sizes = ImagePyramid.level_sizes(
+            self.original_image_size,
+            self.pyramid_levels,
+        )
 
-        return image
+        decoded_images = decode_images(
+            [image_paths[row] for row in rows],
+            partial(
+                decode_pyramid,
+                level_sizes=level_sizes,
+                draft=self.draft_decoding,
+            ),
+            num_workers=self.decode_workers,
+        )
 
-    @property
-    def _saved_images_path(self) -> str:
-        return os.path.join(
-            self.root_dir,
-            f'images_{self.resized_image_size}_{self.csv_file}.pt'
+        cache.append(
+            [row_keys[row] for row in rows],
+            [self.data_frame.iloc[row]['document'] for row in rows],
+            level_sizes,
+            tqdm(decoded_images, total=len(rows)),
         )
 
-    @property
-    def _saved_points_path(self) -> str:
-        return os.path.join(
+    def _load_landmarks(self, directory: str) -> LandmarkStore:
+        """
+        The landmarks of the CSV in columnar form. A landmark file
+        written by ingest_annotations.py next to the CSV is used if it
+        was written with this version of the CSV, i.e. if the hash of
+        the CSV it holds matches. Otherwise, the CSV is parsed once per
+        version of the CSV file into the cache, and landmarks of
+        earlier versions are removed.
+        """
+        csv_hash = LandmarkStore.file_hash(os.path.join(self.root_dir, self.csv_file))
+        ingested_path = os.path.join(
             self.root_dir,
-            f'points_{self.resized_image_size}_{self.csv_file}.pt'
+            LandmarkStore.csv_landmarks_file(self.csv_file),
         )
 
-    def _load_dataset(self) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        images = []
-        points = []
+        if os.path.exists(ingested_path):
+            landmarks = LandmarkStore.load(ingested_path)
 
-        for index in tqdm(range(len(self.data_frame))):
-            image = self._load_image(index)
-            image_points = self._load_points(index)
+            if landmarks.csv_hash == csv_hash:
+                return landmarks
 
-            images.append(image)
-            points.append(image_points)
+            print(f'{ingested_path} is older than {self.csv_file}, ignoring it')
 
-        return (
-            torch.stack(images),
-            torch.stack(points),
-        )
+        landmarks_path = self._saved_landmarks_path(directory, csv_hash)
 
-    def _load_data(self) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        point_ids = self._load_point_ids()
+        if os.path.exists(landmarks_path):
+            return LandmarkStore.load(landmarks_path)
 
-        if os.path.exists(self._saved_images_path) \
-                and os.path.exists(self._saved_points_path):
+        for name in os.listdir(directory):
+            if name.startswith(('landmarks_', 'points_')):
+                os.remove(os.path.join(directory, name))
 
-            images = torch.load(self._saved_images_path)
-            points = torch.load(self._saved_points_path)
+        landmarks = LandmarkStore.from_data_frame(
+            self.data_frame,
+            self.original_image_size,
+            csv_hash,
+        )
+        landmarks.save(landmarks_path)
 
-        else:
-            images, points = self._load_dataset()
+        return landmarks
 
-            self._save_to_pickle(images, points)
+    def _load_points(self) -> tuple[torch.Tensor, list[str]]:
+        landmarks = self._load_landmarks(self.image_store.path)
+        points = landmarks.resized(
+            self.original_image_size,
+            self.resized_image_size,
+        )
 
-        return images, points, point_ids
+        return points, landmarks.point_ids
 
-    def _load_point_ids(self) -> list[str]:
-        points_str = self.data_frame.iloc[0]['points']
-        points_dict = ast.literal_eval(points_str)
+    def load_rows(self, rows: list[int]) -> None:
+        """
+        Make the images of the given rows available. Only images that
+        are new or changed since the cache was last updated are
+        decoded, and no other rows are touched at all. In lazy mode,
+        images are not decoded up front but on demand in __getitem__.
+        Images in shared memory cover the whole dataset, so with
+        shared_memory all rows are loaded.
+        """
+        if self.shared_memory:
+            rows = range(len(self.data_frame))
 
-        ids = [key for key in points_dict]
+        rows = [row for row in rows if self.row_keys[row] is None]
 
-        return ids
+        if len(rows) == 0:
+            return
 
-    def _resize_point(self, point: dict[str, float]) -> dict[str, float]:
-        x_ratio = self.resized_image_size[1] / self.original_image_size[1]
-        y_ratio = self.resized_image_size[0] / self.original_image_size[0]
+        print(
+            f'Loading {len(rows)} rows lazily...' if self.lazy
+            else f'Loading {len(rows)} rows into memory...'
+        )
 
-        resized = [
-            point['x'] * x_ratio,
-            point['y'] * y_ratio,
-        ]
+        image_paths = {row: self._image_path(row) for row in rows}
 
-        if resized[0] > self.resized_image_size[1]:
-            resized[0] = -1
+        for row in rows:
+            self.row_keys[row] = self._row_key(row, image_paths[row])
 
-        if resized[1] > self.resized_image_size[0]:
-            resized[1] = -1
+        missing_rows = [
+            rows[position] for position in
+            self.image_store.missing([self.row_keys[row] for row in rows])
+        ]
 
-        return resized
+        if len(missing_rows) > 0 and not self.lazy:
+            print(f'Decoding {len(missing_rows)} new or changed images...')
+            self._load_dataset(
+                self.image_store,
+                image_paths,
+                self.row_keys,
+                missing_rows,
+            )
+            self.cache.update(self.key)
 
-    def _load_points(self, index: int, resize=True) -> list[torch.Tensor]:
-        points_str = self.data_frame.iloc[index]['points']
-        points_dict = ast.literal_eval(points_str)
+        self.pyramid = self.image_store.pyramid(self.row_keys)
+        self.images = self.pyramid.resized(self.resized_image_size) \
+            if len(self.pyramid.segments) > 0 else None
 
-        points = [
-            self._resize_point(points_dict[key])
-            if resize
-            else [points_dict[key]['x'], points_dict[key]['y']]
-            for key in points_dict
-        ]
+        if self.shared_memory and self.images is not None:
+            self.images = self._attach_shared_images(
+                self.key,
+                self.row_keys,
+                self.images,
+            )
 
-        return torch.Tensor(points)
+        print('Done!')
 
-    def _save_to_pickle(
+    def _attach_shared_images(
         self,
-        images: torch.Tensor,
-        points: torch.Tensor,
-    ):
-        torch.save(images, self._saved_images_path)
-        torch.save(points, self._saved_points_path)
+        key: str,
+        row_keys: list[str],
+        images: ResizedImages,
+    ) -> ImageCache:
+        """
+        The resized images in shared memory, published by the first
+        job on this node that uses this dataset at this size.
+        """
+        name = hashlib.sha1(
+            '\0'.join([key, str(self.resized_image_size), *row_keys]).encode()
+        ).hexdigest()[:32]
+
+        return SharedImageStore(name).attach(
+            self.data_frame['document'].tolist(),
+            (1, *self.resized_image_size),
+            lambda: (images[index].numpy() for index in tqdm(range(len(images)))),
+        )
 
     def __len__(self) -> int:
         return len(self.data_frame)
 
-    def _handle_invalid_points(
-        self,
-        original_points: torch.Tensor,
-        flipped_points: torch.Tensor
-    ) -> torch.Tensor:
-        invalid_points = (
-            original_points[:, 0] <= 0
-        ) | (
-            original_points[:, 1] <= 0
-        )
+    @staticmethod
+    def to_float(images: torch.Tensor) -> torch.Tensor:
+        if images.dtype == torch.uint8:
+            images = images.float() / 255
 
-        flipped_points[invalid_points, :] = -1
+        return images
 
-        return flipped_points
+    def _get_image(self, idx: int) -> torch.Tensor:
+        """
+        Images come from the memory-mapped cache if they are in it,
+        where the page cache already keeps recently read images in
+        memory. In lazy mode, images that are not cached are decoded
+        on demand and kept in a byte-bounded LRU cache. Otherwise,
+        images of rows that were never loaded are decoded directly.
+        """
+        if self.images is not None and idx in self.images:
+            return self.images[idx]
 
-    def _flip_horizontally(
-        self,
-        image: torch.Tensor,
-        points: torch.Tensor,
-    ) -> tuple[torch.Tensor, torch.Tensor]:
-        image = torch.flip(image, [-1])
-        _, height, width = image.shape
+        if self.image_cache is None:
+            return self._load_image(idx)
 
-        flipped_points = points.clone()
-
-        flipped_points[..., 0] = self.resized_image_size[1] - flipped_points[..., 0]
-
-        flipped_points = self._handle_invalid_points(
-            points,
-            flipped_points
-        )
+        image = self.image_cache.get(idx)
 
-        return image, flipped_points
+        if image is None:
+            image = self._load_image(idx)
+            self.image_cache.put(idx, image)
 
-    def _flip_vertically(
-        self,
-        image: torch.Tensor,
-        points: torch.Tensor,
-    ) -> tuple[torch.Tensor, torch.Tensor]:
-        image = torch.flip(image, [1])
-
-        flipped_points = points.clone()
-
-        flipped_points[..., 1] = self.resized_image_size[0] - flipped_points[..., 1]
-
-        flipped_points = self._handle_invalid_points(
-            points,
-            flipped_points
-        )
-
-        return image, flipped_points
+        return image
 
-    def _flip_image(
-        self,
-        image: torch.Tensor,
-        points: torch.Tensor,
-    ) -> tuple[torch.Tensor, torch.Tensor]:
-        if torch.rand(1) > 0.5:
-            (
-                image,
-                points,
-            ) = self._flip_horizontally(
-                image,
-                points,
+    def image_cache_stats(self) -> dict[str, float]:
+        """
+        The stats of the LRU cache of lazy mode over the main process
+        and all DataLoader workers, or none without it.
+        """
+        return self.image_cache.stats() if self.image_cache is not None else {}
+
+    def level_image(self, idx: int, level: int) -> torch.Tensor:
+        """
+        The image at pyramid level level, i.e. at 1 / 2^level of the
+        original size, without resizing it further. Images that are
+        not in the cache are decoded at that size; levels that are not
+        among pyramid_levels are never cached and raise a ValueError.
+        """
+        if level not in self.pyramid_levels:
+            raise ValueError(
+                f'Level {level} is not one of the pyramid levels {self.pyramid_levels}'
             )
 
-        if torch.rand(1) > 0.5:
-            (
-                image,
-                points,
-            ) = self._flip_vertically(
-                image,
-                points,
-            )
+        if self.pyramid is not None and idx in self.pyramid:
+            return self.pyramid.image(idx, self.pyramid_levels.index(level))
 
-        return image, points
+        level_size, = ImagePyramid.level_sizes(self.original_image_size, [level])
+
+        return torch.from_numpy(decode_image(
+            self._image_path(idx),
+            level_size,
+            draft=self.draft_decoding,
+        ))
 
     def __getitem__(self, idx: int) -> tuple[torch.Tensor, torch.Tensor]:
-        image = self.images[idx]
+        image = self._get_image(idx)
         points = self.points[idx]
 
         if self.transform is not None:
-            image = self.transform(image)
+            image = self.transform(self.to_float(image))
 
-        if self.flip_augmentations:
-            image, points = self._flip_image(
-                image,
-                points,
-            )
-
-        return image.to(self.device), points.to(self.device)
+        return image, points
@@ -0,0 +1,106 @@
+from typing import Iterator
+import torch
+from torch.utils.data import Sampler
+
+
+class LossAwareSampler(Sampler):
+    """
+    Draws training samples with probability
+        uniform_fraction / N + (1 - uniform_fraction) * loss_i / sum(loss)
+    so that hard radiographs are seen more often while every sample
+    keeps a floor probability. Per-sample losses are not computed in
+    extra passes; they are refreshed from the losses of the training
+    steps as an exponential moving average with factor momentum.
+    Samples that were never trained on count with the largest known
+    loss, so they are drawn early.
+    The indices of an epoch are kept, so that the losses of batch
+    batch_idx can be assigned to its samples: batches are cut from
+    the drawn indices in order, which the DataLoader preserves even
+    with workers. This only holds if the sampler feeds the DataLoader
+    itself, not through a distributed wrapper; SampleLossLogger
+    checks this before training.
+    """
+    def __init__(
+        self,
+        num_samples: int,
+        batch_size: int,
+        uniform_fraction: float = 0.5,
+        momentum: float = 0.9,
+        samples_per_epoch: int = None,
+        seed: int = 0,
+    ):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.uniform_fraction = uniform_fraction
+        self.momentum = momentum
+        self.samples_per_epoch = samples_per_epoch or num_samples
+        self.seed = seed
+        self.epoch = 0
+
+        self.losses = torch.zeros(num_samples)
+        self.seen = torch.zeros(num_samples, dtype=torch.bool)
+        self.indices = torch.zeros(0, dtype=torch.long)
+
+    def __len__(self) -> int:
+        return self.samples_per_epoch
+
+    def probabilities(self) -> torch.Tensor:
+        losses = self.losses.clone()
+
+        if self.seen.any():
+            losses[~self.seen] = losses[self.seen].max()
+        else:
+            losses[:] = 1
+
+        uniform = torch.full_like(losses, 1 / self.num_samples)
+
+        if losses.sum() <= 0:
+            return uniform
+
+        return self.uniform_fraction * uniform \
+            + (1 - self.uniform_fraction) * losses / losses.sum()
+
+    def __iter__(self) -> Iterator[int]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed * 1_000_003 + self.epoch)
+        self.epoch += 1
+
+        self.indices = torch.multinomial(
+            self.probabilities(),
+            self.samples_per_epoch,
+            replacement=True,
+            generator=generator,
+        )
+
+        yield from self.indices.tolist()
+
+    def update(self, batch_idx: int, sample_losses: torch.Tensor) -> None:
+        """
+        Record the losses of the samples of training batch batch_idx.
+        """
+        start = batch_idx * self.batch_size
+        indices = self.indices[start:start + len(sample_losses)]
+        sample_losses = sample_losses.detach().float().cpu()[:len(indices)]
+
+        self.losses[indices] = torch.where(
+            self.seen[indices],
+            self.momentum * self.losses[indices] + (1 - self.momentum) * sample_losses,
+            sample_losses,
+        )
+        self.seen[indices] = True
+
+    def stats(self) -> dict[str, float]:
+        probabilities = self.probabilities()
+        seen_losses = self.losses[self.seen]
+
+        return {
+            'seen_fraction': self.seen.float().mean().item(),
+            'mean_sample_loss': seen_losses.mean().item() if len(seen_losses) > 0 else 0.0,
+            'max_sample_loss': seen_losses.max().item() if len(seen_losses) > 0 else 0.0,
+            'effective_sample_fraction': (
+                1 / (probabilities ** 2).sum() / self.num_samples
+            ).item(),
+            'unique_sample_fraction': (
+                len(self.indices.unique()) / self.num_samples
+            ),
+        }
@@ -0,0 +1,21 @@
+from lightning import Callback, Trainer, LightningModule
+
+
+class ShardEpochCallback(Callback):
+    """
+    Sets the epoch of the training shards of the datamodule before
+    every training epoch, so that they are shuffled differently every
+    epoch. Lightning only sets the epoch of samplers, and workers
+    that are not persistent start from a fresh copy of the dataset.
+    """
+    def on_train_epoch_start(
+        self,
+        trainer: Trainer,
+        pl_module: LightningModule,
+    ) -> None:
+        train_shards = getattr(trainer.datamodule, 'train_shards', None)
+
+        if train_shards is None:
+            return
+
+        train_shards.set_epoch(trainer.current_epoch)
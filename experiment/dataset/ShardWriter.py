@@ -0,0 +1,104 @@
+import io
+import json
+import os
+import tarfile
+import numpy as np
+
+
+class ShardWriter:
+    """
+    Packs samples into a directory of tar shards for sequential
+    streaming. Every sample is a dict of fields, e.g.
+    {'document': str, 'image.png': bytes, 'points': np.ndarray},
+    stored as consecutive tar members named <key>.<field>. A new
+    shard is started once the current one holds max_samples samples
+    or max_bytes bytes, whichever comes first.
+    Shards are written under a temporary name and renamed when
+    complete. shards.json, listing the shards with their sample
+    counts and any metadata passed to close, is written last and
+    marks the directory as complete.
+    """
+    index_file = 'shards.json'
+
+    def __init__(
+        self,
+        output_dir: str,
+        max_samples: int = 256,
+        max_bytes: int = 1024 ** 3,
+    ):
+        self.output_dir = output_dir
+        self.max_samples = max_samples
+        self.max_bytes = max_bytes
+
+        self.shards = []
+        self.num_samples = 0
+        self.tar = None
+
+        os.makedirs(output_dir, exist_ok=True)
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        if isinstance(value, bytes):
+            return value
+
+        if isinstance(value, str):
+            return value.encode()
+
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(value))
+
+        return buffer.getvalue()
+
+    def _shard_path(self, shard: int) -> str:
+        return os.path.join(self.output_dir, f'shard-{shard:06d}.tar')
+
+    def _open_shard(self) -> None:
+        self.shard_path = self._shard_path(len(self.shards))
+        self.tar = tarfile.open(f'{self.shard_path}.tmp', 'w')
+        self.shard_samples = 0
+        self.shard_bytes = 0
+
+    def _close_shard(self) -> None:
+        if self.tar is None:
+            return
+
+        self.tar.close()
+        os.replace(f'{self.shard_path}.tmp', self.shard_path)
+
+        self.shards.append({
+            'name': os.path.basename(self.shard_path),
+            'num_samples': self.shard_samples,
+        })
+        self.tar = None
+
+    def write(self, sample: dict) -> None:
+        if self.tar is None:
+            self._open_shard()
+
+        key = f'{self.num_samples:08d}'
+
+        for field, value in sample.items():
+            data = self._encode(value)
+
+            info = tarfile.TarInfo(f'{key}.{field}')
+            info.size = len(data)
+            self.tar.addfile(info, io.BytesIO(data))
+
+            self.shard_bytes += len(data)
+
+        self.shard_samples += 1
+        self.num_samples += 1
+
+        if self.shard_samples >= self.max_samples \
+                or self.shard_bytes >= self.max_bytes:
+            self._close_shard()
+
+    def close(self, metadata: dict = None) -> None:
+        self._close_shard()
+
+        with open(os.path.join(self.output_dir, self.index_file), 'w') as file:
+            json.dump({
+                **(metadata or {}),
+                'num_samples': self.num_samples,
+                'shards': self.shards,
+            }, file, indent=2)
@@ -0,0 +1,222 @@
+import io
+import json
+import os
+import random
+import tarfile
+from typing import Iterator
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+from dataset.ShardWriter import ShardWriter
+from dataset.decode_image import decode_image
+
+
+class ShardedRadiographDataset(IterableDataset):
+    """
+    Streams samples from tar shards written by write_shards.py, so
+    every rank and worker reads a few large files sequentially
+    instead of the whole image tree of a dataset.
+    Shards are shuffled per epoch and dealt out to distributed ranks
+    first and DataLoader workers second, and samples are shuffled
+    again through a buffer of buffer_size samples. All ranks yield
+    the same number of samples per epoch, so distributed training
+    does not wait on a rank that ran out of data.
+    The epoch advances with every pass over the dataset. This
+    happens in each worker when workers are persistent; otherwise
+    call set_epoch before every epoch.
+    Samples are (image, points) pairs just like those of
+    LateralSkullRadiographDataset. rows lists the CSV rows of all
+    samples, so that they can be checked against the splits.
+    """
+    def __init__(
+        self,
+        shard_dir: str,
+        resized_image_size: tuple[int, int],
+        shuffle: bool = True,
+        buffer_size: int = 256,
+        seed: int = 0,
+        draft_decoding: bool = False,
+    ):
+        self.shard_dir = shard_dir
+        self.resized_image_size = resized_image_size
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.draft_decoding = draft_decoding
+        self.epoch = 0
+
+        with open(os.path.join(shard_dir, ShardWriter.index_file), 'r') as file:
+            index = json.load(file)
+
+        self.shards = index['shards']
+        self.rows = index.get('rows')
+        self.point_ids = index['point_ids']
+        self.original_image_size = tuple(index['original_image_size'])
+        self.original_image_size_mm = tuple(index['original_image_size_mm'])
+
+    @property
+    def num_points(self) -> int:
+        return len(self.point_ids)
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    @staticmethod
+    def _rank() -> tuple[int, int]:
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+
+        return 0, 1
+
+    @staticmethod
+    def _worker() -> tuple[int, int]:
+        worker_info = get_worker_info()
+
+        if worker_info is None:
+            return 0, 1
+
+        return worker_info.id, worker_info.num_workers
+
+    def _rank_shards(self, rank: int, world_size: int) -> list[list[int]]:
+        """
+        The shards of every rank. The shard order is the same on all
+        ranks for a given seed and epoch, and is padded by repeating
+        shards from the start so every rank gets at least one.
+        """
+        order = list(range(len(self.shards)))
+
+        if self.shuffle:
+            random.Random(self.seed * 1_000_003 + self.epoch).shuffle(order)
+
+        while len(order) % world_size != 0 or len(order) < world_size:
+            order.append(order[len(order) % len(self.shards)])
+
+        return [order[rank::world_size] for rank in range(world_size)]
+
+    def _worker_budgets(
+        self,
+        shards: list[int],
+        num_samples: int,
+        num_workers: int,
+    ) -> list[int]:
+        """
+        How many samples each worker yields so that the workers of a
+        rank yield num_samples together. Samples beyond that are
+        dropped from the last workers first.
+        """
+        budgets = [
+            sum(self.shards[shard]['num_samples'] for shard in shards[worker::num_workers])
+            for worker in range(num_workers)
+        ]
+        excess = sum(budgets) - num_samples
+
+        for worker in reversed(range(num_workers)):
+            dropped = min(excess, budgets[worker])
+            budgets[worker] -= dropped
+            excess -= dropped
+
+        return budgets
+
+    def _num_samples(self, rank_shards: list[list[int]]) -> int:
+        """
+        The number of samples every rank yields, that of the rank
+        with the fewest samples.
+        """
+        return min(
+            sum(self.shards[shard]['num_samples'] for shard in shards)
+            for shards in rank_shards
+        )
+
+    def __len__(self) -> int:
+        rank, world_size = self._rank()
+
+        return self._num_samples(self._rank_shards(rank, world_size))
+
+    def _read_shard(self, shard: int) -> Iterator[dict]:
+        """
+        Read the samples of a shard in one sequential pass. The
+        members of a sample are stored next to each other.
+        """
+        path = os.path.join(self.shard_dir, self.shards[shard]['name'])
+        sample, sample_key = {}, None
+
+        with tarfile.open(path, 'r|') as tar:
+            for member in tar:
+                key, field = member.name.split('.', 1)
+
+                if key != sample_key and len(sample) > 0:
+                    yield sample
+                    sample = {}
+
+                sample_key = key
+                sample[field] = tar.extractfile(member).read()
+
+        if len(sample) > 0:
+            yield sample
+
+    def _decode(self, sample: dict) -> tuple[torch.Tensor, torch.Tensor]:
+        image_field = next(field for field in sample if field.startswith('image.'))
+
+        image = torch.from_numpy(decode_image(
+            io.BytesIO(sample[image_field]),
+            self.resized_image_size,
+            draft=self.draft_decoding,
+        ))
+
+        points = np.load(io.BytesIO(sample['points']))
+        valid = np.load(io.BytesIO(sample['valid']))
+
+        scale = np.array(self.resized_image_size[::-1], dtype=np.float32) \
+            / np.array(self.original_image_size[::-1], dtype=np.float32)
+        points = np.where(valid[..., None], points * scale, -1)
+
+        return image, torch.from_numpy(points.astype(np.float32))
+
+    def _shuffled(self, samples: Iterator, rng: random.Random) -> Iterator:
+        buffer = []
+
+        for sample in samples:
+            if len(buffer) < self.buffer_size:
+                buffer.append(sample)
+                continue
+
+            index = rng.randrange(len(buffer))
+            buffer[index], sample = sample, buffer[index]
+
+            yield sample
+
+        rng.shuffle(buffer)
+
+        yield from buffer
+
+    def __iter__(self) -> Iterator[tuple[torch.Tensor, torch.Tensor]]:
+        rank, world_size = self._rank()
+        worker, num_workers = self._worker()
+
+        rank_shards = self._rank_shards(rank, world_size)
+        num_samples = self._num_samples(rank_shards)
+
+        shards = rank_shards[rank]
+        budget = self._worker_budgets(shards, num_samples, num_workers)[worker]
+
+        samples = (
+            sample
+            for shard in shards[worker::num_workers]
+            for sample in self._read_shard(shard)
+        )
+
+        if self.shuffle:
+            rng = random.Random(
+                ((self.seed * 1_000_003 + self.epoch) * 1_009 + rank) * 1_009 + worker
+            )
+            samples = self._shuffled(samples, rng)
+
+        for index, sample in enumerate(samples):
+            if index >= budget:
+                break
+
+            yield self._decode(sample)
+
+        self.epoch += 1
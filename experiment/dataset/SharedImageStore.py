@@ -0,0 +1,196 @@
+import atexit
+import fcntl
+import glob
+import json
+import os
+from contextlib import contextmanager
+from typing import Callable, Iterator
+import numpy as np
+
+from dataset.ImageCache import ImageCache
+
+
+def default_shared_memory_dir() -> str:
+    return os.environ.get('CEPHALOMETRY_SHARED_MEMORY_DIR', '/dev/shm')
+
+
+class SharedImageStore:
+    """
+    Resized images published once per node in shared memory, so
+    concurrent jobs on the same dataset and image size hold one copy
+    of them in RAM instead of one each.
+    The first process to attach decodes the images into an
+    ImageCache under directory (/dev/shm by default, which is backed
+    by RAM), while later processes wait for it under a file lock and
+    then map the same file read-only. Attached processes are counted
+    by pid in a reference file. The images are removed when the last
+    process detaches, which happens at interpreter exit. Processes
+    that died without detaching are dropped from the count the next
+    time any process attaches or detaches. The images of jobs that
+    were killed before they could detach stay in RAM until then, or
+    until remove_stale removes them.
+    """
+    prefix = 'cephalometry_'
+
+    def __init__(self, name: str, directory: str = None):
+        self.directory = directory if directory is not None \
+            else default_shared_memory_dir()
+        self.path = os.path.join(self.directory, f'{self.prefix}{name}.u8')
+        self.attached = False
+
+    @property
+    def _references_path(self) -> str:
+        return f'{self.path}.refs'
+
+    @property
+    def _lock_path(self) -> str:
+        return f'{self.path}.lock'
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """
+        The lock file is removed with the images, so a process that
+        waited on a lock file that was removed in the meantime locks
+        the current one instead.
+        """
+        while True:
+            lock = open(self._lock_path, 'a')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            try:
+                current = os.stat(self._lock_path).st_ino == os.fstat(lock.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+
+            if current:
+                break
+
+            lock.close()
+
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    @staticmethod
+    def _alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+
+        return True
+
+    def _read_references(self) -> list[int]:
+        if not os.path.exists(self._references_path):
+            return []
+
+        with open(self._references_path, 'r') as file:
+            return [pid for pid in json.load(file) if self._alive(pid)]
+
+    def _write_references(self, references: list[int]) -> None:
+        with open(self._references_path, 'w') as file:
+            json.dump(references, file)
+
+    def _files(self) -> list[str]:
+        return [
+            self.path,
+            ImageCache.index_path(self.path),
+            self._references_path,
+            self._lock_path,
+        ]
+
+    def _remove(self, lock: bool = True) -> None:
+        """
+        Remove the files of the store, including the lock file if
+        lock, which must only be done right before releasing it.
+        """
+        for path in self._files() if lock else self._files()[:-1]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def remove_stale(directory: str = None) -> list[tuple[str, int]]:
+        """
+        Remove the shared images that no living process is attached
+        to, e.g. those of jobs that were killed. Returns the path and
+        size of every removed store.
+        """
+        directory = directory if directory is not None \
+            else default_shared_memory_dir()
+        names = {
+            os.path.basename(path)[len(SharedImageStore.prefix):].split('.', 1)[0]
+            for path in glob.glob(os.path.join(directory, f'{SharedImageStore.prefix}*'))
+        }
+        removed = []
+
+        for name in sorted(names):
+            store = SharedImageStore(name, directory)
+
+            with store._locked():
+                if len(store._read_references()) > 0:
+                    continue
+
+                nbytes = sum(
+                    os.path.getsize(path) for path in store._files()
+                    if os.path.exists(path)
+                )
+                store._remove()
+
+            removed.append((store.path, nbytes))
+
+        return removed
+
+    def attach(
+        self,
+        documents: list[str],
+        image_shape: tuple[int, int, int],
+        images: Callable[[], Iterator[np.ndarray]],
+    ) -> ImageCache:
+        """
+        Attach to the shared images, publishing them first if no
+        other process has. images is only called when publishing.
+        """
+        with self._locked():
+            references = self._read_references()
+
+            if len(references) == 0 or not ImageCache.exists(self.path):
+                self._remove(lock=False)
+
+                print(f'Publishing images to {self.path}...')
+                shared_images = ImageCache.create(self.path, documents, image_shape)
+
+                for index, image in enumerate(images()):
+                    shared_images[index] = image
+
+                ImageCache.finalize(self.path, shared_images, documents)
+                del shared_images
+
+            if not self.attached:
+                self._write_references(references + [os.getpid()])
+
+        if not self.attached:
+            self.attached = True
+            atexit.register(self.detach)
+
+        return ImageCache(self.path, mode='r')
+
+    def detach(self) -> None:
+        if not self.attached:
+            return
+
+        with self._locked():
+            references = self._read_references()
+
+            if os.getpid() in references:
+                references.remove(os.getpid())
+
+            if len(references) == 0:
+                self._remove()
+            else:
+                self._write_references(references)
+
+        self.attached = False
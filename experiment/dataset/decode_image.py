@@ -0,0 +1,136 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import IO, Callable, Iterator
+import numpy as np
+import torch
+from torchvision import transforms
+from PIL import Image
+
+
+def find_image_path(root_dir: str, document: str) -> str:
+    img_name = os.path.join(root_dir, f"images/{document}")
+
+    if not os.path.exists(img_name):
+        if os.path.exists(img_name + '.jpg'):
+            img_name += '.jpg'
+
+        if os.path.exists(img_name + '.png'):
+            img_name += '.png'
+
+    return img_name
+
+
+def available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
+
+def decode_image(
+    path: str | IO[bytes],
+    resized_image_size: tuple[int, int] = None,
+    draft: bool = False,
+) -> np.ndarray:
+    """
+    Radiographs are grayscale, so they are decoded into a single
+    uint8 channel of shape (1, height, width). Conversion to float
+    happens batch-wise later on.
+    With draft=True, JPEGs are decoded with DCT scaling at the
+    smallest power-of-two reduction that is still at least as large
+    as resized_image_size, and only the remaining step is resized
+    exactly. Other formats ignore the draft request.
+    path may also be a file object holding the encoded image.
+    """
+    image = Image.open(path)
+
+    if draft and resized_image_size is not None:
+        height, width = resized_image_size
+        image.draft('L', (width, height))
+
+    image = transforms.PILToTensor()(image.convert('L'))
+
+    if resized_image_size is not None:
+        image = transforms.Resize(resized_image_size)(image)
+
+    return image.numpy()
+
+
+def read_image_size(path: str) -> tuple[int, int]:
+    """
+    The (height, width) of an image, read from its header without
+    decoding it, or None if the image does not exist or cannot be
+    read.
+    """
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+    except (FileNotFoundError, OSError):
+        return None
+
+    return height, width
+
+
+def decode_pyramid(
+    path: str,
+    level_sizes: list[tuple[int, int]],
+    draft: bool = False,
+) -> list[np.ndarray]:
+    """
+    Decode an image once and downscale it to every size in
+    level_sizes, which are expected from largest to smallest.
+    Each level is resized from the previous one.
+    """
+    image = torch.from_numpy(decode_image(path, level_sizes[0], draft=draft))
+    levels = [image]
+
+    for size in level_sizes[1:]:
+        image = transforms.Resize(size)(image)
+        levels.append(image)
+
+    return [level.numpy() for level in levels]
+
+
+def _init_worker() -> None:
+    torch.set_num_threads(1)
+
+
+def decode_images(
+    paths: list[str],
+    decode: Callable = decode_image,
+    num_workers: int = None,
+) -> Iterator:
+    """
+    Decode images in a process pool and yield them in the order
+    of paths. At most two images per worker are in flight at any
+    time, so memory stays bounded however large the dataset is.
+    decode has to be picklable, e.g. a module-level function or a
+    functools.partial of one. With num_workers=0, images are decoded
+    in this process.
+    """
+    if num_workers is None:
+        num_workers = available_cpus()
+
+    num_workers = min(num_workers, len(paths))
+
+    if num_workers == 0:
+        yield from map(decode, paths)
+        return
+
+    max_pending = 2 * num_workers
+
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=_init_worker,
+    ) as executor:
+        pending = deque()
+
+        for path in paths:
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+            pending.append(executor.submit(decode, path))
+
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,169 @@
+import argparse
+import os
+import shutil
+from argparse import Namespace
+from collections import Counter
+import numpy as np
+import pandas as pd
+import yaml
+
+from dataset.LandmarkStore import LandmarkStore
+from dataset.decode_image import find_image_path, decode_images, read_image_size
+
+
+def get_args() -> dict:
+    parser = argparse.ArgumentParser(
+        description="Convert raw landmark annotations into a dataset directory "
+        "with images/, a points CSV, metadata.yaml and a landmark array file."
+    )
+    parser.add_argument("--source", nargs="+", type=str, required=True)
+    parser.add_argument("--format", type=str, choices=["wide", "dict"], default="wide")
+    parser.add_argument("--header", action=argparse.BooleanOptionalAction)
+    parser.add_argument("--num_points", type=int, default=None)
+    parser.add_argument("--source_root", type=str, default=None)
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--csv_file", type=str, default="points.csv")
+    parser.add_argument("--pixel_size_mm", type=float, default=0.1)
+    parser.add_argument("--workers", type=int, default=None)
+
+    return parser.parse_args()
+
+
+def read_wide(
+    path: str,
+    header: bool,
+    num_points: int = None,
+) -> tuple[np.ndarray, list[str], np.ndarray]:
+    """
+    A CSV with the document in the first column followed by the
+    x and y coordinate of every landmark, e.g. the cepha CSVs.
+    """
+    data_frame = pd.read_csv(path, header=0 if header else None)
+
+    if num_points is None:
+        num_points = (data_frame.shape[1] - 1) // 2
+
+    points = data_frame.iloc[:, 1:num_points * 2 + 1].to_numpy(dtype=np.float32)
+
+    return (
+        data_frame.iloc[:, 0].astype(str).to_numpy(),
+        [str(point_id) for point_id in range(num_points)],
+        points.reshape(len(data_frame), num_points, 2),
+    )
+
+
+def read_dict(path: str) -> tuple[np.ndarray, list[str], np.ndarray]:
+    """
+    A CSV in the project's format, with a document and a points
+    column of dict strings.
+    """
+    data_frame = pd.read_csv(path, dtype={"document": str, "points": str})
+    point_ids, points = LandmarkStore.parse_points(data_frame["points"])
+
+    return data_frame["document"].to_numpy(), point_ids, points
+
+
+def read_sources(args: Namespace) -> tuple[np.ndarray, list[str], np.ndarray]:
+    sources = [
+        read_wide(path, args.header, args.num_points)
+        if args.format == "wide" else read_dict(path)
+        for path in args.source
+    ]
+
+    point_ids = sources[0][1]
+
+    for path, (_, source_point_ids, _) in zip(args.source, sources):
+        if source_point_ids != point_ids:
+            raise ValueError(
+                f"{path} has the point ids {source_point_ids}, "
+                f"but {args.source[0]} has {point_ids}"
+            )
+
+    return (
+        np.concatenate([documents for documents, _, _ in sources]),
+        point_ids,
+        np.concatenate([points for _, _, points in sources]),
+    )
+
+
+def check_images(
+    image_paths: list[str],
+    workers: int = None,
+) -> tuple[tuple[int, int], np.ndarray]:
+    """
+    The size most images have, and which images exist and have it.
+    Image headers are read in parallel.
+    """
+    sizes = list(decode_images(image_paths, read_image_size, num_workers=workers))
+
+    found = [size for size in sizes if size is not None]
+
+    if len(found) == 0:
+        raise ValueError("None of the images exist")
+
+    image_size, _ = Counter(found).most_common(1)[0]
+
+    for path, size in zip(image_paths, sizes):
+        if size is None:
+            print(f"Missing or unreadable: {path}")
+        elif size != image_size:
+            print(f"Size {size} instead of {image_size}: {path}")
+
+    return image_size, np.array([size == image_size for size in sizes])
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    source_root = args.source_root if args.source_root is not None else args.output_dir
+
+    documents, point_ids, points = read_sources(args)
+    print(f"Read {len(documents)} rows with {len(point_ids)} points each")
+
+    image_paths = [find_image_path(source_root, document) for document in documents]
+    image_size, usable = check_images(image_paths, args.workers)
+
+    print(
+        f"Keeping {usable.sum()} of {len(documents)} rows with "
+        f"{image_size[0]}x{image_size[1]} images"
+    )
+
+    documents, points = documents[usable], points[usable]
+    image_paths = [path for path, keep in zip(image_paths, usable) if keep]
+
+    images_dir = os.path.join(args.output_dir, "images")
+    os.makedirs(images_dir, exist_ok=True)
+
+    if os.path.abspath(source_root) != os.path.abspath(args.output_dir):
+        for path in image_paths:
+            shutil.copy2(path, images_dir)
+
+    csv_path = os.path.join(args.output_dir, args.csv_file)
+
+    pd.DataFrame({
+        "document": documents,
+        "points": LandmarkStore.format_points(point_ids, points),
+    }).to_csv(csv_path, index=False)
+
+    with open(os.path.join(args.output_dir, "metadata.yaml"), "w") as file:
+        yaml.safe_dump({
+            "image_height": image_size[0],
+            "image_width": image_size[1],
+            "image_height_mm": image_size[0] * args.pixel_size_mm,
+            "image_width_mm": image_size[1] * args.pixel_size_mm,
+        }, file, sort_keys=False)
+
+    LandmarkStore.from_points(
+        documents,
+        point_ids,
+        points,
+        image_size,
+        LandmarkStore.file_hash(csv_path),
+    ).save(
+        os.path.join(
+            args.output_dir,
+            LandmarkStore.csv_landmarks_file(args.csv_file),
+        )
+    )
+
+    print(f"Wrote {args.csv_file}, metadata.yaml and landmarks to {args.output_dir}")
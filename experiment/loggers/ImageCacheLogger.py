@@ -0,0 +1,21 @@
+from lightning import Callback, Trainer, LightningModule
+
+
+class ImageCacheLogger(Callback):
+    """
+    Logs the hits, misses and size of the LRU image cache of lazy
+    loading at the end of every training epoch, summed over the main
+    process and all DataLoader workers.
+    """
+    def on_train_epoch_end(
+        self,
+        trainer: Trainer,
+        pl_module: LightningModule,
+    ) -> None:
+        image_cache_stats = getattr(trainer.datamodule, 'image_cache_stats', None)
+
+        if image_cache_stats is None:
+            return
+
+        for name, value in image_cache_stats().items():
+            pl_module.log(name, float(value))
@@ -23,23 +23,10 @@ class ImagePredictionLogger(Callback):
         trainer: Trainer,
         pl_module: LightningModule
     ) -> None:
-        val_loader = trainer.datamodule.val_dataloader()
-        val_loader_iter = iter(val_loader)
-        original_batch_size = val_loader.batch_size
-
-        if original_batch_size == 1:
-            images, targets = [], []
-            for _ in range(self.num_samples):
-                image, target = next(val_loader_iter)
-                images.append(image)
-                targets.append(target)
-
-            images = torch.cat(images, dim=0)
-            targets = torch.cat(targets, dim=0)
-        else:
-            images, targets = next(val_loader_iter)
-
-        images = images[:self.num_samples]
+        images, targets = trainer.datamodule.preview_batch(
+            self.num_samples,
+            pl_module.device,
+        )
 
         pl_module.show_images(images, targets)
 
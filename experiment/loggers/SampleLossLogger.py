@@ -0,0 +1,63 @@
+from lightning import Callback, Trainer, LightningModule
+
+
+class SampleLossLogger(Callback):
+    """
+    Feeds the per-sample losses of every training step into the
+    LossAwareSampler of the datamodule and logs the sampler's stats
+    at the end of every training epoch. Training steps have to return
+    a dict with 'loss' and 'sample_losses'.
+    The sampler matches losses to samples by the position of their
+    batch in the indices it drew, so it has to feed the training
+    DataLoader itself, on a single process.
+    """
+    def on_train_start(
+        self,
+        trainer: Trainer,
+        pl_module: LightningModule,
+    ) -> None:
+        sampler = getattr(trainer.datamodule, 'sampler', None)
+
+        if sampler is None:
+            return
+
+        if trainer.world_size > 1:
+            raise ValueError(
+                'Hard example sampling does not work with distributed '
+                'training, where every rank only draws part of the indices'
+            )
+
+        if getattr(trainer.train_dataloader, 'sampler', None) is not sampler:
+            raise ValueError(
+                'Hard example sampling needs the LossAwareSampler of the '
+                'datamodule to feed the training DataLoader directly'
+            )
+
+    def on_train_batch_end(
+        self,
+        trainer: Trainer,
+        pl_module: LightningModule,
+        outputs: dict,
+        batch: tuple,
+        batch_idx: int,
+    ) -> None:
+        sampler = getattr(trainer.datamodule, 'sampler', None)
+
+        if sampler is None or not isinstance(outputs, dict) \
+                or 'sample_losses' not in outputs:
+            return
+
+        sampler.update(batch_idx, outputs['sample_losses'])
+
+    def on_train_epoch_end(
+        self,
+        trainer: Trainer,
+        pl_module: LightningModule,
+    ) -> None:
+        sampler = getattr(trainer.datamodule, 'sampler', None)
+
+        if sampler is None:
+            return
+
+        for name, value in sampler.stats().items():
+            pl_module.log(f'sampler_{name}', value)
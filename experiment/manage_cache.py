@@ -0,0 +1,149 @@
+import argparse
+import os
+import time
+import pandas as pd
+
+from dataset.CacheDirectory import CacheDirectory
+from dataset.IncrementalImageCache import IncrementalImageCache
+from dataset.SharedImageStore import SharedImageStore
+from dataset.decode_image import find_image_path
+
+
+def get_args() -> dict:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache_dir", type=str, default=None)
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("list")
+
+    prune_parser = subparsers.add_parser("prune")
+    prune_parser.add_argument("--max_gb", type=float, required=True)
+
+    remove_parser = subparsers.add_parser("remove")
+    remove_parser.add_argument("keys", nargs="+", type=str)
+
+    compact_parser = subparsers.add_parser(
+        "compact",
+        help="Drop the images of rows the CSV no longer has from entries, "
+        "all entries if no keys are given",
+    )
+    compact_parser.add_argument("keys", nargs="*", type=str)
+
+    clean_shared_parser = subparsers.add_parser(
+        "clean_shared",
+        help="Remove images in shared memory that no running job uses, "
+        "e.g. those of killed jobs",
+    )
+    clean_shared_parser.add_argument("--shared_memory_dir", type=str, default=None)
+
+    return parser.parse_args()
+
+
+def format_entry(entry: dict) -> str:
+    last_used = time.strftime(
+        "%Y-%m-%d %H:%M", time.localtime(entry["last_used"])
+    )
+
+    return (
+        f"{entry['key']}  {entry['nbytes'] / 1024 ** 3:8.2f} GB  "
+        f"last used {last_used}  "
+        f"{entry['root_dir']}/{entry['csv_file']}  "
+        f"levels {entry['pyramid_levels']}"
+        f"{' (draft)' if entry['draft_decoding'] else ''}"
+    )
+
+
+def live_row_keys(entry: dict) -> list[str]:
+    """
+    The row keys of the current rows of the CSV of an entry. Rows
+    whose image is gone are left out.
+    """
+    data_frame = pd.read_csv(
+        os.path.join(entry["root_dir"], entry["csv_file"]),
+        dtype={"document": str, "points": str},
+    )
+    image_paths = [
+        find_image_path(entry["root_dir"], document)
+        for document in data_frame["document"]
+    ]
+
+    return [
+        IncrementalImageCache.row_key(document, points, image_path)
+        for document, points, image_path in zip(
+            data_frame["document"],
+            data_frame["points"],
+            image_paths,
+        )
+        if os.path.exists(image_path)
+    ]
+
+
+def compact(cache: CacheDirectory, entry: dict) -> tuple[int, int]:
+    image_cache = IncrementalImageCache(
+        cache.path(entry["key"]),
+        entry["pyramid_levels"],
+    )
+    before, after = image_cache.compact(live_row_keys(entry))
+    cache.update(entry["key"])
+
+    return before, after
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    cache = CacheDirectory(args.cache_dir)
+
+    if args.command == "list":
+        entries = cache.entries()
+
+        for entry in entries:
+            print(format_entry(entry))
+
+        total = sum(entry["nbytes"] for entry in entries)
+        print(f"{len(entries)} entries, {total / 1024 ** 3:.2f} GB in {cache.root}")
+
+    elif args.command == "prune":
+        evicted = cache.prune(int(args.max_gb * 1024 ** 3))
+
+        for entry in evicted:
+            print(f"Removed {format_entry(entry)}")
+
+        print(f"Removed {len(evicted)} entries")
+
+    elif args.command == "remove":
+        for key in args.keys:
+            cache.remove(key)
+            print(f"Removed {key}")
+
+    elif args.command == "compact":
+        entries = [
+            entry for entry in cache.entries()
+            if len(args.keys) == 0 or entry["key"] in args.keys
+        ]
+        total_before, total_after = 0, 0
+
+        for entry in entries:
+            before, after = compact(cache, entry)
+            total_before += before
+            total_after += after
+
+            print(
+                f"Compacted {entry['key']}  {before / 1024 ** 3:8.2f} GB -> "
+                f"{after / 1024 ** 3:8.2f} GB  {entry['root_dir']}/{entry['csv_file']}"
+            )
+
+        print(
+            f"Compacted {len(entries)} entries from {total_before / 1024 ** 3:.2f} GB "
+            f"to {total_after / 1024 ** 3:.2f} GB"
+        )
+
+    elif args.command == "clean_shared":
+        removed = SharedImageStore.remove_stale(args.shared_memory_dir)
+
+        for path, nbytes in removed:
+            print(f"Removed {path}  {nbytes / 1024 ** 3:8.2f} GB")
+
+        total = sum(nbytes for _, nbytes in removed)
+        print(f"Removed {len(removed)} shared image stores, {total / 1024 ** 3:.2f} GB")
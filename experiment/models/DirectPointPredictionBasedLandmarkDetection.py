@@ -52,7 +52,7 @@ class DirectPointPredictionBasedLandmarkDetection(L.LightningModule):
         preds = clamp_points(preds, images).cpu().numpy()
         targets = clamp_points(targets, images).cpu().numpy()
 
-        images = images.permute(0, 2, 3, 1).cpu().numpy()
+        images = images[:, 0].cpu().numpy()
 
         num_samples = images.shape[0]
 
@@ -67,21 +67,28 @@ class DirectPointPredictionBasedLandmarkDetection(L.LightningModule):
 
     def step(
         self,
-        batch: tuple[torch.Tensor, torch.Tensor],
-        with_mm_error: bool = False
+        batch: tuple[torch.Tensor, ...],
+        with_mm_error: bool = False,
+        return_sample_losses: bool = False,
     ):
-        inputs, targets = batch
+        """
+        With return_sample_losses, the loss is a (loss, sample_losses)
+        pair, see MaskedWingLoss.
+        """
+        inputs, targets, *image_size_mm = batch
 
         predictions = self.model(inputs)
 
         loss = self.loss(
             predictions,
             targets,
+            return_sample_losses=return_sample_losses,
         )
 
         unreduced_mm_error = self.mean_radial_error(
             predictions,
             targets,
+            *image_size_mm,
         ) if with_mm_error else None
 
         return loss, unreduced_mm_error, predictions, targets
@@ -91,7 +98,10 @@ class DirectPointPredictionBasedLandmarkDetection(L.LightningModule):
         batch: tuple[torch.Tensor, torch.Tensor],
         batch_idx: int
     ):
-        loss, _, _, _ = self.step(batch, with_mm_error=True)
+        (loss, sample_losses), _, _, _ = self.step(
+            batch,
+            return_sample_losses=True,
+        )
 
         self.log(
             'train_loss',
@@ -101,7 +111,7 @@ class DirectPointPredictionBasedLandmarkDetection(L.LightningModule):
             prog_bar=True
         )
 
-        return loss
+        return {'loss': loss, 'sample_losses': sample_losses.detach()}
 
     def validation_step(
         self,
@@ -1,4 +1,5 @@
 from __future__ import print_function, division
+import time
 import torch
 import torch.nn as nn
 import lightning as L
@@ -6,8 +7,8 @@ from torch.optim.lr_scheduler import ReduceLROnPlateau
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
 from utils.clamp_points import clamp_points
-import numpy as np
 
+from models.LandmarkDecoders import LandmarkDecoders
 from models.losses.HeatmapOffsetmapLoss import HeatmapOffsetmapLoss
 from models.metrics.MeanRadialError import MeanRadialError
 from utils.HeatmapHelper import HeatmapHelper
@@ -24,15 +25,31 @@ class HeatmapBasedLandmarkDetection(L.LightningModule):
         batch_size: int = 1,
         output_size: int = 19,
         reduce_lr_patience: int = 25,
+        decoder: str = LandmarkDecoders.default,
+        decoder_radius: int = 40,
+        compare_decoders: bool = False,
+        sparse_loss: bool = False,
+        background_samples: int = 4096,
         *args,
         **kwargs,
     ):
+        """
+        decoder names the LandmarkDecoders strategy points are decoded
+        with. Testing logs the mm error and decode time of it, or of
+        every strategy with compare_decoders. sparse_loss and
+        background_samples configure the training loss, see
+        HeatmapOffsetmapLoss.
+        """
         super().__init__()
 
         self.model = model
         self.batch_size = batch_size
 
-        self.loss = HeatmapOffsetmapLoss(resized_image_size)
+        self.loss = HeatmapOffsetmapLoss(
+            resized_image_size,
+            sparse=sparse_loss,
+            background_samples=background_samples,
+        )
 
         self.mean_radial_error = MeanRadialError(
             resized_image_size=resized_image_size,
@@ -43,6 +60,10 @@ class HeatmapBasedLandmarkDetection(L.LightningModule):
 
         self.reduce_lr_patience = reduce_lr_patience
 
+        self.decoder = decoder
+        self.decoder_radius = decoder_radius
+        self.compare_decoders = compare_decoders
+
         self.heatmap_helper = HeatmapHelper(
             original_image_size=original_image_size,
             resized_image_size=resized_image_size,
@@ -71,8 +92,7 @@ class HeatmapBasedLandmarkDetection(L.LightningModule):
         height: int,
         width: int,
     ) -> torch.Tensor:
-        return self.loss.cut_out_rectangles(
-            self.loss.general_heatmap,
+        return self.loss.target_heatmaps(
             targets,
             height,
             width,
@@ -104,7 +124,7 @@ class HeatmapBasedLandmarkDetection(L.LightningModule):
         preds = clamp_points(preds, images).cpu().numpy()
         targets = clamp_points(targets, images).cpu().numpy()
 
-        images = images.permute(0, 2, 3, 1).cpu().numpy()
+        images = images[:, 0].cpu().numpy()
 
         num_samples = images.shape[0]
 
@@ -133,72 +153,103 @@ class HeatmapBasedLandmarkDetection(L.LightningModule):
 
         return self.get_points(output)
 
-    def regression_voting(self, heatmaps, R):
-        topN = int(R * R * 3.1415926)
-        heatmap = heatmaps
-        imageNum, featureNum, h, w = heatmap.size()
-        landmarkNum = int(featureNum / 3)
-        heatmap = heatmap.contiguous().view(imageNum, featureNum, -1)
-
-        predicted_landmarks = torch.zeros((imageNum, landmarkNum, 2), device=self.device)
-        Pmap = heatmap[:, 0:landmarkNum, :].data
-        Xmap = torch.round(heatmap[:, landmarkNum : landmarkNum * 2, :].data * R).long() * w
-        Ymap = torch.round(heatmap[:, landmarkNum * 2 : landmarkNum * 3, :].data * R).long()
-        topkP, indexs = torch.topk(Pmap, topN)
-
-        for imageId in range(imageNum):
-            for landmarkId in range(landmarkNum):
-
-                topnXoff = Xmap[imageId][landmarkId][
-                    indexs[imageId][landmarkId]
-                ]  # offset in x direction
-
-                topnYoff = Ymap[imageId][landmarkId][
-                    indexs[imageId][landmarkId]
-                ]  # offset in y direction
-
-                VotePosi = (
-                    (topnXoff + topnYoff + indexs[imageId][landmarkId])
-                    .cpu()
-                    .numpy()
-                    .astype("int")
-                )
-
-                tem = VotePosi[VotePosi >= 0]
-                maxid = 0
-
-                if len(tem) > 0:
-                    maxid = np.argmax(np.bincount(tem))
-
-                x = maxid // w
-                y = maxid - x * w
-                #x, y = x / (h - 1), y / (w - 1)
-                predicted_landmarks[imageId][landmarkId] = torch.tensor([y, x], device=self.device)
-        return predicted_landmarks
+    def decode(self, model_output: torch.Tensor, decoder: str) -> torch.Tensor:
+        return LandmarkDecoders.get_decoder(decoder)(
+            model_output,
+            self.decoder_radius,
+        )
 
     def get_points(self, model_output: torch.Tensor):
-        return self.regression_voting(model_output, 40)
+        return self.decode(model_output, self.decoder)
+
+    def timed_decode(
+        self,
+        model_output: torch.Tensor,
+        decoder: str,
+    ) -> tuple[torch.Tensor, float]:
+        """
+        The decoded points and the time decoding took in ms,
+        waiting for all queued GPU work before and after.
+        """
+        if model_output.is_cuda:
+            torch.cuda.synchronize(model_output.device)
+
+        start_time = time.perf_counter()
+        points = self.decode(model_output, decoder)
+
+        if model_output.is_cuda:
+            torch.cuda.synchronize(model_output.device)
+
+        return points, (time.perf_counter() - start_time) * 1000
+
+    def log_decoders(
+        self,
+        model_output: torch.Tensor,
+        targets: torch.Tensor,
+        *image_size_mm: torch.Tensor,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Log the mean mm error and decode time of the decoder, or of all
+        decoders with compare_decoders, and return the points and the
+        unreduced mm error of the decoder.
+        """
+        decoders = LandmarkDecoders.get_decoder_names() \
+            if self.compare_decoders else [self.decoder]
+
+        for decoder in decoders:
+            points, milliseconds = self.timed_decode(model_output, decoder)
+
+            mm_error = self.mean_radial_error(points, targets, *image_size_mm)
+
+            if decoder == self.decoder:
+                point_predictions, unreduced_mm_error = points, mm_error
+
+            self.log(f'{decoder}_mm_error', mm_error.mean())
+            self.log(f'{decoder}_decode_ms', milliseconds)
+
+        return point_predictions, unreduced_mm_error
 
     def step(
         self,
-        batch: tuple[torch.Tensor, torch.Tensor],
-        with_mm_error: bool = False
+        batch: tuple[torch.Tensor, ...],
+        with_mm_error: bool = False,
+        with_decoder_logs: bool = False,
+        return_sample_losses: bool = False,
     ):
-        inputs, targets = batch
+        """
+        Points are only decoded for the mm error or the decoder logs.
+        With return_sample_losses, the loss is a (loss, sample_losses)
+        pair, see HeatmapOffsetmapLoss.
+        """
+        inputs, targets, *image_size_mm = batch
 
         predictions = self.forward_with_heatmaps(inputs)
 
         loss = self.loss(
             predictions,
             targets,
+            return_sample_losses=return_sample_losses,
         )
 
-        point_predictions = self.get_points(predictions)
+        point_predictions, unreduced_mm_error = None, None
 
-        unreduced_mm_error = self.mean_radial_error(
-            point_predictions,
-            targets,
-        ) if with_mm_error else None
+        if with_decoder_logs:
+            point_predictions, unreduced_mm_error = self.log_decoders(
+                predictions,
+                targets,
+                *image_size_mm,
+            )
+
+            if not with_mm_error:
+                unreduced_mm_error = None
+        elif with_mm_error:
+            point_predictions = self.get_points(predictions)
+
+            unreduced_mm_error = self.mean_radial_error(
+                point_predictions,
+                targets,
+                *image_size_mm,
+            )
 
         return loss, unreduced_mm_error, point_predictions, targets
 
@@ -207,7 +258,10 @@ class HeatmapBasedLandmarkDetection(L.LightningModule):
         batch: tuple[torch.Tensor, torch.Tensor],
         batch_idx: int
     ):
-        loss, _, _, _ = self.step(batch)
+        (loss, sample_losses), _, _, _ = self.step(
+            batch,
+            return_sample_losses=True,
+        )
 
         self.log(
             'train_loss',
@@ -217,7 +271,7 @@ class HeatmapBasedLandmarkDetection(L.LightningModule):
             prog_bar=True
         )
 
-        return loss
+        return {'loss': loss, 'sample_losses': sample_losses.detach()}
 
     def validation_step(
         self,
@@ -243,7 +297,7 @@ class HeatmapBasedLandmarkDetection(L.LightningModule):
             mm_error,
             predictions,
             targets
-        ) = self.step(batch, with_mm_error=True)
+        ) = self.step(batch, with_mm_error=True, with_decoder_logs=True)
 
         for (id, point_id) in enumerate(self.point_ids):
             self.log(f'{point_id}_mm_error', mm_error.mean(dim=0)[id].mean())
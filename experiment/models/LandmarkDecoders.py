@@ -0,0 +1,44 @@
+from typing import Callable
+import torch
+
+from utils.regression_voting import regression_voting, coarse_to_fine_voting
+from utils.heatmap_decoding import (
+    argmax_decoding,
+    soft_argmax_decoding,
+    argmax_offset_decoding,
+)
+
+
+class LandmarkDecoders:
+    """
+    The strategies to turn heatmap model outputs of shape
+    (batch_size, 3 * num_points, height, width) into (x, y) points.
+    Every decoder is called with the model output and the radius of
+    the training targets, and decodes the whole batch at once.
+    From slowest and most robust to fastest:
+    - regression_voting: votes of the top pixels of every heatmap
+    - coarse_to_fine_voting: the same votes, with the top pixels
+      searched for only around the peak of every heatmap
+    - soft_argmax: weighted mean around the highest pixel
+    - argmax_offset: highest pixel moved by its predicted offset
+    - argmax: highest pixel
+    """
+    default = 'regression_voting'
+
+    @staticmethod
+    def decoders() -> dict[str, Callable[[torch.Tensor, int], torch.Tensor]]:
+        return {
+            'regression_voting': regression_voting,
+            'coarse_to_fine_voting': coarse_to_fine_voting,
+            'soft_argmax': soft_argmax_decoding,
+            'argmax_offset': argmax_offset_decoding,
+            'argmax': argmax_decoding,
+        }
+
+    @staticmethod
+    def get_decoder(name: str) -> Callable[[torch.Tensor, int], torch.Tensor]:
+        return LandmarkDecoders.decoders()[name]
+
+    @staticmethod
+    def get_decoder_names() -> list[str]:
+        return list(LandmarkDecoders.decoders().keys())
@@ -17,6 +17,7 @@ from models.backbones.Segformer import Segformer
 class ModelType:
     resized_image_size: tuple[int, int]
     model: nn.Module
+    fully_convolutional: bool = False
 
     def initialize(self, *args, **kwargs) -> nn.Module:
         return self.model(*args, **kwargs)
@@ -64,6 +65,7 @@ class ModelTypes(Enum):
                     *args,
                     **kwargs,
                 ),
+                fully_convolutional=True,
             ),
             "SegformerLarge": ModelType(
                 resized_image_size=(640, 640),
@@ -75,6 +77,7 @@ class ModelTypes(Enum):
                     *args,
                     **kwargs,
                 ),
+                fully_convolutional=True,
             ),
             "ViTSmall": ModelType(
                 resized_image_size=(224, 224),
@@ -3,6 +3,8 @@ from torch import nn
 from typing import Callable
 from transformers import ConvNextV2Model
 
+from utils.expand_channels import expand_channels
+
 
 class ConvNextV2(nn.Module):
     def __init__(
@@ -24,7 +26,7 @@ class ConvNextV2(nn.Module):
         self.output_size = output_size
 
     def forward(self, images: torch.Tensor) -> torch.Tensor:
-        output = self.model(images).pooler_output
+        output = self.model(expand_channels(images)).pooler_output
         return self.head(output).reshape(-1, self.output_size, 2)
 
     def _load_model(self, model_name: str) -> Callable:
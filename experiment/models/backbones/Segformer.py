@@ -2,6 +2,8 @@ import torch
 from torch import nn
 from transformers import SegformerForSemanticSegmentation
 
+from utils.expand_channels import expand_channels
+
 
 class Segformer(nn.Module):
     def __init__(
@@ -32,6 +34,6 @@ class Segformer(nn.Module):
         return model, model.config
 
     def forward(self, images: torch.Tensor) -> torch.Tensor:
-        output = self.backbone(images).logits
+        output = self.backbone(expand_channels(images)).logits
 
         return output
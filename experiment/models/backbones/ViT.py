@@ -2,6 +2,8 @@ import torch
 from torch import nn
 from transformers import ViTModel
 
+from utils.expand_channels import expand_channels
+
 
 class Downscaling(nn.Sequential):
     def __init__(self):
@@ -57,7 +59,7 @@ class ViT(nn.Module):
         return model, model.config
 
     def forward(self, images: torch.Tensor) -> torch.Tensor:
-        output = self.model(images).last_hidden_state[:, 0, :]
+        output = self.model(expand_channels(images)).last_hidden_state[:, 0, :]
         output = self.head(output).reshape(-1, self.output_size, 2)
 
         return output
@@ -10,6 +10,7 @@ import numpy as np
 from models.losses.HeatmapOffsetmapLoss import HeatmapOffsetmapLoss
 from models.metrics.MeanRadialError import MeanRadialError
 from utils.HeatmapHelper import HeatmapHelper
+from utils.expand_channels import expand_channels
 
 
 class dilationInceptionModule(nn.Module):
@@ -369,7 +370,7 @@ class fusionVGG19(nn.Module):
         return attentionMaps
 
     def forward(self, x):
-        x = self.VGG_layer1(x)
+        x = self.VGG_layer1(expand_channels(x))
         f1 = self.f_conv1(x)
 
         x = self.VGG_layer2(x)
@@ -491,7 +492,7 @@ class ChenConvNext(nn.Module):
         return attentionMaps
 
     def forward(self, x):
-        x = self.model.embeddings(x)
+        x = self.model.embeddings(expand_channels(x))
 
         x = self.model.encoder.stages[0](x)
         f1 = self.f_conv1(x)
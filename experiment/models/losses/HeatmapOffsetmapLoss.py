@@ -11,230 +11,328 @@ class HeatmapOffsetmapLoss(nn.Module):
         heatmap_radius: int = 40,
         offsetmap_radius: int = 40,
         gaussian: bool = False,
+        sparse: bool = False,
+        background_samples: int = 4096,
     ):
+        """
+        With sparse, training losses are computed from the pixels of
+        the target discs and background_samples sampled background
+        pixels per landmark only, see sparse_losses. Validation and
+        testing always use every pixel.
+        """
         super().__init__()
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+        self.resized_image_size = resized_image_size
         self.heatmap_radius = heatmap_radius
         self.offsetmap_radius = offsetmap_radius
-
-        self.init_offset_and_heatmaps(
-            resized_image_size,
-            heatmap_radius,
-            offsetmap_radius,
-            gaussian
+        self.gaussian = gaussian
+        self.sparse = sparse
+        self.background_samples = background_samples
+
+        rows, columns = torch.meshgrid(
+            torch.arange(-heatmap_radius, heatmap_radius + 1),
+            torch.arange(-heatmap_radius, heatmap_radius + 1),
+            indexing='ij',
         )
+        disc = (rows ** 2 + columns ** 2).sqrt() <= heatmap_radius
 
-    def init_offset_and_heatmaps(
-        self,
-        resized_image_size: tuple[int, int],
-        heatmap_radius: int,
-        offsetmap_radius: int,
-        gaussian: bool,
-    ):
-        height, width = resized_image_size
-
-        self.init_general_heatmap(height, width, heatmap_radius, gaussian)
-        self.init_general_offsetmap_x(height, width, offsetmap_radius)
-        self.init_general_offsetmap_y(height, width, offsetmap_radius)
+        self.register_buffer(
+            'disc_offsets',
+            torch.stack([rows[disc], columns[disc]], dim=-1),
+            persistent=False,
+        )
 
-    def init_general_offsetmap_x(
+    def _landmark_grids(
         self,
+        landmarks: torch.Tensor,
         height: int,
         width: int,
-        offsetmap_radius: int
-    ):
-        self.general_offsetmap_x = torch.arange(
-            height * 2, device=self.device, dtype=torch.float32
-        ).view(-1, 1).expand(height * 2, width * 2)
-
-        self.general_offsetmap_x = height - self.general_offsetmap_x
-        self.general_offsetmap_x /= offsetmap_radius
-
-    def init_general_offsetmap_y(
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        For every landmark, the landmark row minus every pixel row with
+        shape (batch_size, num_points, height, 1), and the landmark
+        column minus every pixel column with shape
+        (batch_size, num_points, 1, width). Landmarks are clamped into
+        the map and rounded to whole pixels first.
+        """
+        x = landmarks[..., 0].clamp(0, width - 1).round().long()
+        y = landmarks[..., 1].clamp(0, height - 1).round().long()
+
+        rows = torch.arange(height, device=landmarks.device).view(1, 1, -1, 1)
+        columns = torch.arange(width, device=landmarks.device).view(1, 1, 1, -1)
+
+        return y[..., None, None] - rows, x[..., None, None] - columns
+
+    def target_heatmaps(
         self,
+        landmarks: torch.Tensor,
         height: int,
         width: int,
-        offsetmap_radius: int
-    ):
-        self.general_offsetmap_y = torch.arange(
-            width * 2, device=self.device, dtype=torch.float32
-        ).view(1, -1).expand(height * 2, width * 2)
+    ) -> torch.Tensor:
+        """
+        Heatmaps of shape (batch_size, num_points, height, width) with a
+        disc of heatmap_radius around every landmark, filled with ones
+        or, if gaussian, with a gaussian of that standard deviation.
+        The heatmaps of missing landmarks are empty.
+        They are computed from the distance of every pixel to the
+        landmark, broadcast from a column and a row per landmark, so no
+        index grids or templates of the maps' size are needed. Squared
+        distances are whole numbers well below 2^24 and thus exact in
+        float32.
+        """
+        row_distances, column_distances = self._landmark_grids(
+            landmarks,
+            height,
+            width,
+        )
+        squared_distances = row_distances.float() ** 2 + column_distances.float() ** 2
+        mask = (squared_distances.sqrt() <= self.heatmap_radius) \
+            & self.valid_landmarks(landmarks)[..., None, None]
 
-        self.general_offsetmap_y = width - self.general_offsetmap_y
+        if self.gaussian:
+            return torch.exp(
+                -0.5 * squared_distances / (self.heatmap_radius ** 2)
+            ) * mask
 
-        self.general_offsetmap_y /= offsetmap_radius
+        return mask.float()
 
-    def init_general_heatmap(
+    def target_offsetmaps(
         self,
+        landmarks: torch.Tensor,
         height: int,
         width: int,
-        heatmap_radius: int,
-        gaussian: bool,
-    ):
-        y_grid, x_grid = torch.meshgrid(
-            torch.arange(0, height * 2, device=self.device),
-            torch.arange(0, width * 2, device=self.device)
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        The vertical and horizontal distance of every pixel to every
+        landmark in units of offsetmap_radius. The vertical offsets only
+        depend on the row and have shape
+        (batch_size, num_points, height, 1), the horizontal ones only on
+        the column and have shape (batch_size, num_points, 1, width);
+        both broadcast against the predicted maps.
+        """
+        row_distances, column_distances = self._landmark_grids(
+            landmarks,
+            height,
+            width,
         )
 
-        if gaussian:
-            self.general_heatmap = torch.exp(
-                -0.5 * ((y_grid - height) ** 2 + (x_grid - width) ** 2)
-                / (heatmap_radius ** 2)
-            )
-
-            distance = (
-                (y_grid - height) ** 2 +
-                (x_grid - width) ** 2
-            ).sqrt()
-
-            mask = distance <= heatmap_radius
-
-            self.general_heatmap = self.general_heatmap * mask
-        else:
-            self.general_heatmap = torch.zeros(
-                (height * 2, width * 2),
-                device=self.device
-            )
-
-            distance = (
-                (y_grid - height) ** 2 +
-                (x_grid - width) ** 2
-            ).sqrt()
-
-            mask = distance <= heatmap_radius
-
-            self.general_heatmap[mask] = 1
+        return (
+            row_distances.float() / self.offsetmap_radius,
+            column_distances.float() / self.offsetmap_radius,
+        )
 
-    def cut_out_rectangles(
+    def clamp_landmarks(
         self,
-        source: torch.Tensor,
-        points: torch.Tensor,
+        landmarks: torch.Tensor,
         height: int,
         width: int,
     ) -> torch.Tensor:
-        batch_size, num_points, _ = points.size()
-        source_height, source_width = source.size()
-
-        x = points[:, :, 0].clamp(0, width - 1).round().long()
-        y = points[:, :, 1].clamp(0, height - 1).round().long()
-
-        x_start = (width - x).view(batch_size, num_points, 1, 1) \
-            .expand(batch_size, num_points, source_height, width)
-
-        y_start = (height - y).view(batch_size, num_points, 1, 1) \
-            .expand(batch_size, num_points, height, width)
-
-        x_indices = x_start + torch.arange(
-            width, device=self.device
-        ).view(1, 1, 1, -1)
-
-        y_indices = y_start + torch.arange(
-            height, device=self.device
-        ).view(1, 1, -1, 1)
-
-        source = source.view(1, 1, source_height, source_width) \
-            .expand(batch_size, num_points, source_height, source_width)
-
-        vertical_strips = torch.gather(source, 3, x_indices)
-
-        rectangles = torch.gather(vertical_strips, 2, y_indices)
-
-        return rectangles
-
-    def clamp_landmarks(
+        """
+        Whole pixel landmarks, clamped into the map at least a pixel
+        away from its top and left edges. Missing landmarks, with a
+        coordinate of 0 or less such as the -1 of points outside of a
+        crop, are set to -1 instead, so that they stay masked.
+        """
+        valid = self.valid_landmarks(landmarks).unsqueeze(-1)
+        landmarks = landmarks.long()
+
+        clamped = torch.stack([
+            landmarks[..., 0].clamp(1, width - 1),
+            landmarks[..., 1].clamp(1, height - 1),
+        ], dim=-1)
+
+        return torch.where(valid, clamped, -1)
+
+    @staticmethod
+    def valid_landmarks(landmarks: torch.Tensor) -> torch.Tensor:
+        """
+        Whether each landmark of shape (..., 2) is annotated.
+        """
+        return (landmarks > 0).all(-1)
+
+    def _background_samples(
         self,
-        landmarks: torch.Tensor,
+        batch_size: int,
+        num_points: int,
         height: int,
         width: int,
-    ) -> torch.Tensor:
-        landmarks[..., 0] = landmarks[..., 0].clamp(1, width - 1)
-        landmarks[..., 1] = landmarks[..., 1].clamp(1, height - 1)
+        device: torch.device,
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        One random pixel per cell of a grid of about
+        background_samples square cells, drawn for every landmark.
+        Returns the rows and columns of shape
+        (batch_size, num_points, num_cells), and the area of every
+        cell, the number of pixels each sample stands for.
+        """
+        cell_size = max(1, int((height * width / self.background_samples) ** 0.5))
+
+        tops = torch.arange(0, height, cell_size, device=device)
+        lefts = torch.arange(0, width, cell_size, device=device)
+        cell_heights = (height - tops).clamp(max=cell_size)
+        cell_widths = (width - lefts).clamp(max=cell_size)
+
+        tops, lefts = [grid.flatten() for grid in torch.meshgrid(tops, lefts, indexing='ij')]
+        cell_heights, cell_widths = [
+            grid.flatten()
+            for grid in torch.meshgrid(cell_heights, cell_widths, indexing='ij')
+        ]
+
+        draws = torch.rand(batch_size, num_points, len(tops), 2, device=device)
 
-        return landmarks
+        return (
+            tops + (draws[..., 0] * cell_heights).long(),
+            lefts + (draws[..., 1] * cell_widths).long(),
+            cell_heights * cell_widths,
+        )
 
-    def mask_tensors(
+    def sparse_losses(
         self,
-        predictions: torch.Tensor,
-        targets: torch.Tensor,
-        mask: torch.Tensor,
-    ) -> torch.Tensor:
-        return (
-            predictions * mask,
-            targets * mask,
+        feature_maps: torch.Tensor,
+        landmarks: torch.Tensor,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        The loss of forward and the loss of every sample, computed
+        without any map of the feature maps' size. The offset loss
+        only covers the target discs anyway, so it is computed exactly
+        from the pixels of every disc, listed by disc_offsets. The
+        heatmap loss covers the discs exactly too; the background,
+        where the target is 0, is estimated from one pixel per cell of
+        a grid, weighted with the area of its cell, which leaves the
+        estimate unbiased. Samples that fall into a disc are dropped,
+        as the disc is already counted. Missing landmarks add nothing,
+        as in the dense loss. Compute and memory grow with
+        the disc area and background_samples instead of the map size.
+        """
+        batch_size, num_maps, height, width = feature_maps.size()
+        num_points = num_maps // 3
+
+        landmarks = self.clamp_landmarks(landmarks, height, width)
+        valid = self.valid_landmarks(landmarks)
+        x = landmarks[..., 0].clamp(0, width - 1)
+        y = landmarks[..., 1].clamp(0, height - 1)
+
+        rows = y.unsqueeze(-1) + self.disc_offsets[:, 0]
+        columns = x.unsqueeze(-1) + self.disc_offsets[:, 1]
+        inside = (rows >= 0) & (rows < height) & (columns >= 0) & (columns < width) \
+            & valid.unsqueeze(-1)
+
+        sample_rows, sample_columns, areas = self._background_samples(
+            batch_size,
+            num_points,
+            height,
+            width,
+            feature_maps.device,
         )
+        background = (sample_rows - y.unsqueeze(-1)) ** 2 \
+            + (sample_columns - x.unsqueeze(-1)) ** 2 > self.heatmap_radius ** 2
+
+        # A single gather from all maps, so that its backward pass
+        # allocates no more than one gradient of the feature maps' size
+        positions = torch.cat([
+            rows.clamp(0, height - 1) * width + columns.clamp(0, width - 1),
+            sample_rows * width + sample_columns,
+        ], dim=-1)
+        predictions = feature_maps.flatten(2).gather(-1, positions.repeat(1, 3, 1))
+
+        disc_size = self.disc_offsets.size(0)
+        predicted_discs = predictions[:, :num_points, :disc_size]
+        predicted_background = predictions[:, :num_points, disc_size:]
+        predicted_offsetmap_x = predictions[:, num_points:num_points * 2, :disc_size]
+        predicted_offsetmap_y = predictions[:, num_points * 2:, :disc_size]
+
+        squared_distances = (self.disc_offsets.float() ** 2).sum(-1)
+        disc_targets = torch.exp(
+            -0.5 * squared_distances / (self.heatmap_radius ** 2)
+        ) if self.gaussian else torch.ones_like(squared_distances)
+
+        disc_losses = F.binary_cross_entropy_with_logits(
+            predicted_discs,
+            disc_targets.expand_as(predicted_discs),
+            reduction='none',
+        ) * inside
+
+        background_losses = F.binary_cross_entropy_with_logits(
+            predicted_background,
+            torch.zeros_like(predicted_background),
+            reduction='none',
+        ) * (background & valid.unsqueeze(-1)) * areas
+
+        offsetmap_losses = (
+            (predicted_offsetmap_x + self.disc_offsets[:, 0] / self.offsetmap_radius).abs()
+            + (predicted_offsetmap_y + self.disc_offsets[:, 1] / self.offsetmap_radius).abs()
+        ) * inside
+
+        heatmap_losses = (
+            disc_losses.sum((1, 2))
+            + background_losses.sum((1, 2))
+        ) / (num_points * height * width)
+
+        loss = 2 * heatmap_losses.mean() \
+            + offsetmap_losses.sum() / inside.sum().clamp(min=1)
+        sample_losses = 2 * heatmap_losses \
+            + offsetmap_losses.sum((1, 2)) / inside.sum((1, 2)).clamp(min=1)
+
+        return loss, sample_losses
 
     def forward(
         self,
         feature_maps: torch.Tensor, 
-        landmarks: torch.Tensor
+        landmarks: torch.Tensor,
+        return_sample_losses: bool = False,
     ) -> torch.Tensor:
-        batch_size, num_points, height, width = feature_maps.size()
-        num_points = num_points // 3
+        """
+        With return_sample_losses, the loss of every sample is
+        returned as well, with shape (batch_size,). It is reduced
+        from the same elementwise losses as the batch loss.
+        """
+        if self.sparse and self.training:
+            loss, sample_losses = self.sparse_losses(feature_maps, landmarks)
 
-        landmarks = self.clamp_landmarks(landmarks.long(), height, width).long()
+            if return_sample_losses:
+                return loss, sample_losses.detach()
 
-        heatmaps = self.cut_out_rectangles(
-            self.general_heatmap,
-            landmarks,
-            height,
-            width,
-        )
-        
-        offsetmap_x = self.cut_out_rectangles(
-            self.general_offsetmap_x,
-            landmarks,
-            height,
-            width,
-        )
+            return loss
 
-        offsetmap_y = self.cut_out_rectangles(
-            self.general_offsetmap_y,
-            landmarks,
-            height,
-            width,
-        )
+        batch_size, num_points, height, width = feature_maps.size()
+        num_points = num_points // 3
 
-        mask = (landmarks > 0).prod(-1) \
-            .view(batch_size, num_points, 1, 1) \
-            .expand(batch_size, num_points, height, width)
+        landmarks = self.clamp_landmarks(landmarks, height, width)
+        valid = self.valid_landmarks(landmarks)
 
+        heatmaps = self.target_heatmaps(landmarks, height, width)
+        offsetmap_x, offsetmap_y = self.target_offsetmaps(landmarks, height, width)
 
-        predicted_heatmaps, heatmaps = self.mask_tensors(
+        heatmap_losses = F.binary_cross_entropy_with_logits(
             feature_maps[:, :num_points],
             heatmaps,
-            mask,
+            reduction='none',
         )
 
-        predicted_offsetmap_x, offsetmap_x = self.mask_tensors(
-            feature_maps[:, num_points:num_points * 2],
-            offsetmap_x,
-            mask,
-        )
+        # Missing landmarks add neither a loss nor a gradient. Batches
+        # without any are left as they are, which saves a masked copy.
+        if not valid.all():
+            heatmap_losses = heatmap_losses * valid.view(batch_size, num_points, 1, 1)
 
-        predicted_offsetmap_y, offsetmap_y = self.mask_tensors(
-            feature_maps[:, num_points * 2:],
-            offsetmap_y,
-            mask,
-        )
+        # The target discs of missing landmarks are empty, so their
+        # offsets are masked too
+        indices = (heatmaps > 0).float()
 
-        heatmap_loss = F.binary_cross_entropy_with_logits(
-            predicted_heatmaps,
-            heatmaps,
-        )
+        offsetmap_losses = (
+            (feature_maps[:, num_points:num_points * 2] - offsetmap_x).abs()
+            + (feature_maps[:, num_points * 2:] - offsetmap_y).abs()
+        ) * indices
 
-        indices = heatmaps > 0
+        heatmap_loss = heatmap_losses.mean()
+        offsetmap_loss = offsetmap_losses.sum() / indices.sum().clamp(min=1)
 
-        offsetmap_x_loss = F.l1_loss(
-            predicted_offsetmap_x[indices],
-            offsetmap_x[indices],
-        )
+        loss = 2 * heatmap_loss + offsetmap_loss
 
-        offsetmap_y_loss = F.l1_loss(
-            predicted_offsetmap_y[indices],
-            offsetmap_y[indices],
-        )
+        if return_sample_losses:
+            sample_losses = 2 * heatmap_losses.mean((1, 2, 3)) \
+                + offsetmap_losses.sum((1, 2, 3)) \
+                / indices.sum((1, 2, 3)).clamp(min=1)
 
-        loss = 2 * heatmap_loss + offsetmap_x_loss + offsetmap_y_loss
+            return loss, sample_losses.detach()
 
         return loss
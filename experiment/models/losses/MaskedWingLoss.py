@@ -40,10 +40,19 @@ class MaskedWingLoss(nn.Module):
         self,
         predictions: torch.Tensor,
         targets: torch.Tensor,
+        return_sample_losses: bool = False,
     ) -> torch.Tensor:
+        """
+        With return_sample_losses, the loss of every sample is
+        returned as well, with shape (batch_size,).
+        """
         loss, magnitude = self.wing_loss(predictions, targets)
 
         mask = (targets > 0).prod(-1)
-        masked_loss = (loss * mask).mean()
+        sample_losses = (loss * mask).mean(-1)
+        masked_loss = sample_losses.mean()
+
+        if return_sample_losses:
+            return masked_loss, sample_losses
 
         return masked_loss
@@ -23,10 +23,21 @@ class MeanRadialError(nn.Module):
         self,
         predicted_points: torch.Tensor,
         ground_truth_points: torch.Tensor,
+        original_image_size_mm: torch.Tensor = None,
     ) -> torch.Tensor:
+        """
+        original_image_size_mm optionally gives the (height, width)
+        in mm of every sample's image, with shape (batch_size, 2),
+        for batches mixing datasets with different pixel spacings.
+        """
+        if original_image_size_mm is None:
+            original_image_size_mm = self.original_image_size_mm
+        else:
+            original_image_size_mm = original_image_size_mm.view(-1, 1, 2).float()
+
         difference = predicted_points - ground_truth_points
         diff_btwn_zero_one = difference / self.resized_image_size.flip(-1)
-        difference_mm = diff_btwn_zero_one * self.original_image_size_mm.flip(-1)
+        difference_mm = diff_btwn_zero_one * original_image_size_mm.flip(-1)
 
         distance = (difference_mm ** 2).sum(dim=-1).sqrt()
 
@@ -0,0 +1,17 @@
+import torch
+
+
+def expand_channels(
+    images: torch.Tensor,
+    num_channels: int = 3
+) -> torch.Tensor:
+    """
+    Radiographs are stored and transferred with a single channel.
+    Backbones pretrained on RGB images get the channel broadcast
+    as a view, which gives the same outputs as three identical
+    channels without copying the images.
+    """
+    if images.size(1) == 1:
+        return images.expand(-1, num_channels, -1, -1)
+
+    return images
@@ -0,0 +1,84 @@
+import torch
+
+
+def _split_model_output(
+    model_output: torch.Tensor,
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    The heatmaps, vertical and horizontal offset maps of model
+    outputs of shape (batch_size, 3 * num_points, height, width).
+    """
+    num_points = model_output.size(1) // 3
+
+    return (
+        model_output[:, :num_points],
+        model_output[:, num_points:num_points * 2],
+        model_output[:, num_points * 2:num_points * 3],
+    )
+
+
+def _argmax_positions(heatmaps: torch.Tensor) -> torch.Tensor:
+    """
+    The flat position of the highest pixel of every heatmap, with
+    shape (batch_size, num_points).
+    """
+    return heatmaps.flatten(2).argmax(-1)
+
+
+def argmax_decoding(model_output: torch.Tensor, radius: int) -> torch.Tensor:
+    """
+    The highest pixel of every heatmap, as (x, y) points of shape
+    (batch_size, num_points, 2). The offset maps are not used.
+    """
+    heatmaps, _, _ = _split_model_output(model_output.detach())
+    width = heatmaps.size(-1)
+    positions = _argmax_positions(heatmaps)
+
+    return torch.stack([positions % width, positions // width], dim=-1).float()
+
+
+def soft_argmax_decoding(model_output: torch.Tensor, radius: int) -> torch.Tensor:
+    """
+    The integral of fusionVGG19.getCoordinate: the mean pixel position
+    weighted by the sigmoid of the heatmaps. Only pixels within radius
+    of the highest pixel are weighted, the disc the heatmaps are
+    trained on, as the background of a whole map pulls the mean
+    towards the image center.
+    """
+    heatmaps, _, _ = _split_model_output(model_output.detach())
+    height, width = heatmaps.shape[-2:]
+    positions = _argmax_positions(heatmaps)
+
+    rows = torch.arange(height, device=heatmaps.device, dtype=torch.float32).view(1, 1, -1, 1)
+    columns = torch.arange(width, device=heatmaps.device, dtype=torch.float32).view(1, 1, 1, -1)
+    peak_rows = (positions // width).view(*positions.shape, 1, 1)
+    peak_columns = (positions % width).view(*positions.shape, 1, 1)
+
+    disc = (rows - peak_rows) ** 2 + (columns - peak_columns) ** 2 <= radius ** 2
+    weights = torch.sigmoid(heatmaps) * disc
+    weight_sums = weights.sum((-2, -1))
+
+    return torch.stack([
+        (weights * columns).sum((-2, -1)) / weight_sums,
+        (weights * rows).sum((-2, -1)) / weight_sums,
+    ], dim=-1)
+
+
+def argmax_offset_decoding(model_output: torch.Tensor, radius: int) -> torch.Tensor:
+    """
+    The highest pixel of every heatmap, moved by the offsets the
+    offset maps predict at that pixel. Offsets are given in units of
+    radius, like the targets of HeatmapOffsetmapLoss.
+    """
+    heatmaps, row_offsets, column_offsets = _split_model_output(model_output.detach())
+    width = heatmaps.size(-1)
+    positions = _argmax_positions(heatmaps).unsqueeze(-1)
+
+    row_offset = row_offsets.flatten(2).gather(-1, positions).squeeze(-1)
+    column_offset = column_offsets.flatten(2).gather(-1, positions).squeeze(-1)
+    positions = positions.squeeze(-1)
+
+    return torch.stack([
+        positions % width + column_offset * radius,
+        positions // width + row_offset * radius,
+    ], dim=-1).float()
@@ -0,0 +1,126 @@
+import torch
+import torch.nn.functional as F
+
+
+def _top_n(radius: int) -> int:
+    return int(radius * radius * 3.1415926)
+
+
+def _count_votes(
+    model_output: torch.Tensor,
+    indices: torch.Tensor,
+    radius: int,
+) -> torch.Tensor:
+    """
+    The pixels at the flat indices of shape
+    (batch_size, num_points, top_n) vote for the flat position their
+    offsets point to; the position with the most votes wins, ties
+    going to the smallest position, and 0 if no vote lands at a
+    non-negative position. Votes are sorted per landmark, and equal
+    runs are counted with a scatter-add. Returns (x, y) points of
+    shape (batch_size, num_points, 2).
+    """
+    batch_size, num_maps, height, width = model_output.size()
+    num_points = num_maps // 3
+
+    offsets = model_output.flatten(2)
+    row_offsets = offsets[:, num_points:num_points * 2].gather(-1, indices)
+    column_offsets = offsets[:, num_points * 2:num_points * 3].gather(-1, indices)
+
+    votes = torch.round(row_offsets * radius).long() * width \
+        + torch.round(column_offsets * radius).long() \
+        + indices
+
+    invalid = votes < 0
+    no_vote = torch.iinfo(votes.dtype).max
+    votes, _ = votes.masked_fill(invalid, no_vote).sort(dim=-1)
+
+    runs = torch.cat([
+        torch.zeros_like(votes[..., :1]),
+        (votes[..., 1:] != votes[..., :-1]).long(),
+    ], dim=-1).cumsum(-1)
+
+    counts = torch.zeros_like(votes).scatter_add_(-1, runs, (votes != no_vote).long())
+    run_votes = torch.zeros_like(votes).scatter_(-1, runs, votes)
+
+    positions = run_votes.gather(-1, counts.argmax(-1, keepdim=True)).squeeze(-1)
+    positions = torch.where(invalid.all(-1), 0, positions)
+
+    rows = positions // width
+    columns = positions - rows * width
+
+    return torch.stack([columns, rows], dim=-1).float()
+
+
+def regression_voting(heatmaps: torch.Tensor, radius: int) -> torch.Tensor:
+    """
+    Decodes landmarks from model outputs of shape
+    (batch_size, 3 * num_points, height, width), holding a heatmap,
+    a vertical and a horizontal offset map per landmark. The
+    int(radius^2 * pi) most likely pixels of every heatmap vote for
+    the position they point to. Votes are counted for all images and
+    landmarks at once on the device of heatmaps, see _count_votes.
+    """
+    heatmaps = heatmaps.detach()
+    num_points = heatmaps.size(1) // 3
+
+    _, indices = torch.topk(heatmaps[:, :num_points].flatten(2), _top_n(radius))
+
+    return _count_votes(heatmaps, indices, radius)
+
+
+def coarse_to_fine_voting(
+    heatmaps: torch.Tensor,
+    radius: int,
+    pool_size: int = 8,
+    window_radius: int = None,
+) -> torch.Tensor:
+    """
+    regression_voting without a top-k over whole heatmaps. The peak
+    of every heatmap is found on a max-pooled heatmap, pool_size
+    times smaller, and then within its pooling cell. The top pixels
+    are only searched for in a square of window_radius (2 * radius by
+    default) around the peak, where they lie as long as the heatmap
+    has a single blob no larger than the training targets. The votes
+    are then counted as in regression_voting. Heatmaps too small for
+    the window are decoded by regression_voting.
+    """
+    heatmaps = heatmaps.detach()
+    batch_size, num_maps, height, width = heatmaps.size()
+    num_points = num_maps // 3
+    top_n = _top_n(radius)
+
+    window_radius = window_radius if window_radius is not None else 2 * radius
+    window_height = min(2 * window_radius + 1, height)
+    window_width = min(2 * window_radius + 1, width)
+
+    if window_height * window_width < top_n \
+            or (window_height, window_width) == (height, width):
+        return regression_voting(heatmaps, radius)
+
+    probabilities = heatmaps[:, :num_points]
+
+    pooled, cell_peaks = F.max_pool2d(
+        probabilities,
+        pool_size,
+        ceil_mode=True,
+        return_indices=True,
+    )
+    peaks = cell_peaks.flatten(2).gather(
+        -1,
+        pooled.flatten(2).argmax(-1, keepdim=True),
+    ).squeeze(-1)
+
+    top = (peaks // width - window_radius).clamp(0, height - window_height)
+    left = (peaks % width - window_radius).clamp(0, width - window_width)
+
+    rows = top.unsqueeze(-1) + torch.arange(window_height, device=heatmaps.device)
+    columns = left.unsqueeze(-1) + torch.arange(window_width, device=heatmaps.device)
+    window = (rows.unsqueeze(-1) * width + columns.unsqueeze(-2)).flatten(2)
+
+    _, window_indices = torch.topk(
+        probabilities.flatten(2).gather(-1, window),
+        top_n,
+    )
+
+    return _count_votes(heatmaps, window.gather(-1, window_indices), radius)
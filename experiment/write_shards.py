@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import pandas as pd
+import yaml
+from tqdm import tqdm
+
+from dataset.LandmarkStore import LandmarkStore
+from dataset.ShardWriter import ShardWriter
+from dataset.decode_image import find_image_path
+
+
+def get_args() -> dict:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root_dir", type=str, default="dataset/novel")
+    parser.add_argument("--csv_file", type=str, default="all_images_37_points.csv")
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument(
+        "--split_file",
+        type=str,
+        required=True,
+        help="Split file of the runs the shards are for, as written by "
+        "training with --split_file; only its training rows are written",
+    )
+    parser.add_argument("--max_samples", type=int, default=256)
+    parser.add_argument("--max_shard_mb", type=int, default=1024)
+
+    return parser.parse_args()
+
+
+def read_metadata(root_dir: str) -> dict:
+    with open(os.path.join(root_dir, "metadata.yaml"), "r") as file:
+        return yaml.safe_load(file)
+
+
+def read_train_rows(split_file: str, num_rows: int) -> list[int]:
+    """
+    The training rows of a split file, so that no validation or test
+    row ends up in the shards.
+    """
+    with open(split_file, "r") as file:
+        saved = json.load(file)
+
+    if saved["num_rows"] != num_rows:
+        raise ValueError(
+            f"{split_file} was written for {saved['num_rows']} rows, "
+            f"but the CSV has {num_rows}"
+        )
+
+    return sorted(saved["train"])
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    metadata = read_metadata(args.root_dir)
+    original_image_size = (metadata["image_height"], metadata["image_width"])
+
+    data_frame = pd.read_csv(
+        os.path.join(args.root_dir, args.csv_file),
+        dtype={"document": str, "points": str},
+    )
+    landmarks = LandmarkStore.from_data_frame(data_frame, original_image_size)
+    train_rows = read_train_rows(args.split_file, len(landmarks))
+
+    writer = ShardWriter(
+        args.output_dir,
+        max_samples=args.max_samples,
+        max_bytes=args.max_shard_mb * 1024 ** 2,
+    )
+
+    for index in tqdm(train_rows):
+        document = landmarks.documents[index]
+        image_path = find_image_path(args.root_dir, document)
+        extension = os.path.splitext(image_path)[1].lstrip(".").lower() or "bin"
+
+        with open(image_path, "rb") as file:
+            image = file.read()
+
+        writer.write({
+            "document": str(document),
+            f"image.{extension}": image,
+            "points": landmarks.points[index],
+            "valid": landmarks.valid[index],
+        })
+
+    writer.close({
+        "root_dir": os.path.abspath(args.root_dir),
+        "csv_file": args.csv_file,
+        "split_file": os.path.abspath(args.split_file),
+        "rows": train_rows,
+        "point_ids": landmarks.point_ids,
+        "original_image_size": list(original_image_size),
+        "original_image_size_mm": [
+            metadata["image_height_mm"],
+            metadata["image_width_mm"],
+        ],
+    })
+
+    print(
+        f"Wrote {writer.num_samples} samples in {len(writer.shards)} shards "
+        f"to {args.output_dir}"
+    )